@@ -7,7 +7,9 @@ on Ubuntu 10.4 LTS.
 from __future__ import with_statement
 from functools import partial
 import os, os.path, time
+import glob, hashlib, json, re, types
 import functools
+from StringIO import StringIO
 
 from fabric.api import *
 from fabric.contrib.files import append, exists, comment, contains
@@ -27,33 +29,219 @@ from fab_settings import *
 #DJANGO_PORT = 81
 #BRANCH = 'master'
 #SERVER_GROUP = 'app'
-#ROLES = ['nginx', 'django', 'database', 'smtp']
+#ROLES = ['nginx', 'django', 'database', 'pooler', 'memcached', 'smtp']
 #PROJECT_DIR = '/project/%s' % PROJECT_NAME # Not templatized in config files
-#VIRTUALENV = '/envs/%s' % PROJECT_NAME # Not templatized in config files
+#VIRTUALENV = '/envs/%s' % PROJECT_NAME # Prefix; each requirements.txt hash gets its own virtualenv
 #DB_PASS = 'foo' # Should not contain quotes; coupled w/settings.py # IGNORED, postgres is now configured to trust local connections
 #GIT_CLONE_USERNAME = 'git'
 #GIT_CLONE_HOST = 'github.com'
 #GIT_CLONE_PSEUDOHOST = PROJECT_NAME # Used to specify site-specific behavior for SSH if multiple projects are hosted on e.g. github.com
 #PG_VERSION = (8, 4)
 #PYTHON_VERSION = (2,6)
+
+# Settings added since the list above; override any of them in fab_settings.py
+def _default(name, value):
+    globals().setdefault(name, value)
+
+_default('DEPLOY_POOL_SIZE', 5) # Max hosts worked on at once by the parallel_* deploy tasks
+_default('DEPLOY_TIMELINE_DIR', './deploy_timelines') # Local dir for deploy timings, see deploy_report
+_default('APT_UPDATE_MAX_AGE', 24 * 60) # Minutes before install_common refreshes the package index and upgrades
+_default('APT_PROXY', None) # e.g. 'http://apt-cache.local:3142' to use a local apt cache/proxy
+_default('RELEASES_TO_KEEP', 10) # Older releases are pruned after each deploy, except current and previous
+_default('HOST_ROLES', {}) # e.g. {'db1.example.com': ['database', 'pooler']}; unlisted hosts run every role, and split their RAM
+_default('WSGI_PROCESSES', None) # mod_wsgi daemon processes per host, split between its backends; None sizes them from the host's CPUs and RAM
+_default('WSGI_THREADS', 10) # Threads per mod_wsgi daemon process
+_default('WSGI_MAXIMUM_REQUESTS', 1000) # Requests before a daemon process is recycled, bounding its memory
+_default('WSGI_PROCESS_MEMORY_MB', 80) # Expected size of one daemon process, for sizing
+_default('WSGI_MEMORY_FRACTION', 0.5) # Share of Django's part of the host's RAM (see HOST_ROLES) the daemon processes may use
+_default('NGINX_HOSTS', None) # Where rolling_restart_django drains backends; None means every host
+_default('NGINX_PPA', 'nginx/stable') # Ubuntu 10.04's nginx is too old for upstream keepalive; None uses it anyway
+_default('NGINX_UPSTREAM_KEEPALIVE', 16) # Idle connections to Apache each nginx worker keeps open
+_default('PG_PROFILE', 'web') # Sizes postgresql.conf for 'web' (OLTP), 'mixed' or 'reporting' use, see Postgres.PROFILES
+_default('PG_SSD', None) # Whether the database disk is an SSD; None asks the kernel (VMs often claim rotational)
+_default('POOLER_PORT', 6432) # Django connects to Postgres through pgbouncer here; None connects directly
+_default('MEMCACHED_HOSTS', ['127.0.0.1']) # Cache nodes, by private address; keys are spread over them by consistent hashing
+_default('MEMCACHED_PORT', 11211)
+_default('MEMCACHED_MEMORY_MB', None) # Per node; None gives it MEMCACHED_MEMORY_FRACTION of its part of the host's RAM (see HOST_ROLES)
+_default('MEMCACHED_MEMORY_FRACTION', 0.125)
+_default('MEMCACHED_CLIENT', 'pylibmc') # Binary protocol via libmemcached; 'python-memcached' for Django's pure-Python client
+_default('DJANGO_BACKENDS', ['127.0.0.1:%d' % DJANGO_PORT]) # 'host:port's nginx balances over; each gets its own daemon processes
+
 #
 #
 # Fabric Hacks
 #
 
-# Fabric excludes `run` and `sudo` from being tasks, for no apparent reason
-# This works around that:
-run = functools.partial(run)
-sudo = functools.partial(sudo)
+class Timeline(object):
+    """
+    Times every run/sudo/put/local call, every task and the main deploy
+    steps. Remote commands can report steps of their own by printing
+    "TIMELINE_STEP <start> <end> <name>" lines, with Unix times. When a deploy
+    finishes, the timings are written to DEPLOY_TIMELINE_DIR as JSON; see
+    deploy_report.
+    """
+    STEP_MARKER = 'TIMELINE_STEP'
+    DEPLOY_TASKS = ['deploy', 'simple_deploy', 'deploy_prep_new_release', 'deploy_activate_release',
+            'parallel_deploy', 'parallel_deploy_prep_new_release', 'parallel_deploy_activate_release']
+
+    events = []
+    depth = 0
+    deploying = False
 
-def upload_template(src, dest, *args, **kwargs):
+    @staticmethod
+    def describe(kind, name, args, kwargs):
+        if kind in ('run', 'sudo', 'local'):
+            return args[0] if args else kwargs.get('command')
+        if kind == 'put':
+            paths = list(args[:2]) + [kwargs.get('local_path'), kwargs.get('remote_path')]
+            return 'put ' + ' '.join(str(p) for p in paths if p is not None)
+        call_args = [repr(a) for a in args] + ['%s=%r' % item for item in sorted(kwargs.items())]
+        return '%s(%s)' % (name, ', '.join(call_args))
+
+    @staticmethod
+    def transferred_bytes(kind, args, kwargs, result):
+        if kind == 'put':
+            local_path = args[0] if args else kwargs.get('local_path')
+            if isinstance(local_path, basestring):
+                return sum(os.path.getsize(p) for p in glob.glob(os.path.expanduser(local_path))
+                    if os.path.isfile(p))
+            if hasattr(local_path, 'getvalue'):
+                return len(local_path.getvalue())
+        elif kind in ('run', 'sudo', 'local') and isinstance(result, basestring):
+            return len(result)
+        return None
+
+    @staticmethod
+    def timed(kind, func, name=None):
+        name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            event = {
+                'kind': kind,
+                'host': 'localhost' if kind == 'local' else env.host_string,
+                'command': Timeline.describe(kind, name, args, kwargs),
+                'depth': Timeline.depth,
+                'start': time.time(),
+                'failed': True,
+            }
+            if kind == 'task' and name in Timeline.DEPLOY_TASKS:
+                Timeline.deploying = True
+            Timeline.depth += 1
+            try:
+                result = func(*args, **kwargs)
+                event['failed'] = bool(getattr(result, 'failed', False))
+                event['bytes'] = Timeline.transferred_bytes(kind, args, kwargs, result)
+                if kind in ('run', 'sudo') and isinstance(result, basestring):
+                    Timeline.add_reported_steps(result)
+                return result
+            finally:
+                Timeline.depth -= 1
+                event['duration'] = time.time() - event['start']
+                Timeline.events.append(event)
+                if Timeline.depth == 0 and Timeline.deploying:
+                    Timeline.write(event)
+        return wrapper
+
+    @staticmethod
+    def add_step(command, start, end, depth=None):
+        """Records a step timed some other way, e.g. on the remote host (whose clock may differ a little)."""
+        Timeline.events.append({
+            'kind': 'step',
+            'host': env.host_string,
+            'command': command,
+            'depth': Timeline.depth if depth is None else depth,
+            'start': start,
+            'duration': end - start,
+            'failed': False,
+        })
+
+    @staticmethod
+    def add_reported_steps(output):
+        for line in output.splitlines():
+            fields = line.split(None, 3)
+            if len(fields) == 4 and fields[0] == Timeline.STEP_MARKER:
+                Timeline.add_step(fields[3].strip(), float(fields[1]), float(fields[2]))
+
+    @staticmethod
+    def write(task_event):
+        """Writes out and clears the timeline of the deploy task that just finished."""
+        events, Timeline.events, Timeline.deploying = Timeline.events, [], False
+        if not [e for e in events if e['kind'] in ('run', 'sudo', 'put')]:
+            return # e.g. a @runs_once deploy task on every host but the first
+        if not os.path.isdir(DEPLOY_TIMELINE_DIR):
+            os.makedirs(DEPLOY_TIMELINE_DIR)
+        started = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(task_event['start']))
+        filename = os.path.join(DEPLOY_TIMELINE_DIR, '%s_%s.json' % (started, task_event['command'].split('(')[0]))
+        f = open(filename, 'w')
+        try:
+            json.dump({
+                'task': task_event['command'],
+                'start': task_event['start'],
+                'duration': task_event['duration'],
+                'failed': task_event['failed'],
+                'hosts': sorted(set(e['host'] for e in events if e['host'] and e['kind'] != 'local')),
+                'events': sorted(events, key=lambda e: e['start']),
+            }, f, indent=1)
+        finally:
+            f.close()
+        print 'Wrote deploy timeline to %s' % filename
+
+# Fabric excludes `run` and `sudo` from being tasks, for no apparent reason
+# Wrapping them (and put/local, for timing) works around that:
+run = Timeline.timed('run', run)
+sudo = Timeline.timed('sudo', sudo)
+put = Timeline.timed('put', put)
+local = Timeline.timed('local', local)
+
+def _render_template(src, context=None, use_jinja=False, template_dir=None):
+    """Renders src the same way Fabric's upload_template does."""
+    if use_jinja:
+        from jinja2 import Environment, FileSystemLoader
+        jenv = Environment(loader=FileSystemLoader(template_dir or '.'))
+        return jenv.get_template(src).render(**context or {}).encode('utf-8')
+    text = open(src).read()
+    if context:
+        text = text % context
+    return text
+
+def _remote_md5sums(paths, use_sudo=False):
+    """Returns {path: md5} for those of `paths` that exist, in one round trip."""
+    runner = sudo if use_sudo else run
+    with hide('running', 'stdout'):
+        output = runner('md5sum %s 2>/dev/null; true' % ' '.join(paths))
+    md5sums = {}
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            md5sums[fields[1].strip()] = fields[0]
+    return md5sums
+
+def upload_template(src, dest, context=None, use_jinja=False, template_dir=None, use_sudo=False,
+        batch=None, remote_md5s=None, **kwargs):
     """
-    Wrapper around Fabric's upload_template that sets +r.
+    Wrapper around Fabric's upload_template that sets +r, and skips the upload
+    if the remote file already matches the rendered template.
 
     upload_template does not preserve file permissions, http://code.fabfile.org/issues/show/117
+
+    Returns whether the remote file changed. Pass a sudo Batch as `batch` to
+    queue the chmod instead of running it, and the result of _remote_md5sums
+    as `remote_md5s` to skip looking up the remote checksum.
     """
-    orig_upload_template(src, dest, *args, **kwargs)
-    sudo('chmod +r %s' % dest)
+    rendered = _render_template(src, context, use_jinja, template_dir)
+    if remote_md5s is None:
+        remote_md5s = _remote_md5sums([dest], use_sudo)
+    if remote_md5s.get(dest) == hashlib.md5(rendered).hexdigest():
+        print 'Unchanged, not uploading: %s' % dest
+        return False
+    orig_upload_template(src, dest, context=context, use_jinja=use_jinja, template_dir=template_dir,
+        use_sudo=use_sudo, **kwargs)
+    if batch:
+        assert batch.use_sudo
+        batch.add('chmod +r %s' % dest)
+    else:
+        sudo('chmod +r %s' % dest)
+    return True
 
 def boxed_task(name):
     """
@@ -78,6 +266,95 @@ def home_dir(*args):
         return os.path.join("/root", *args)
     return os.path.join("/home/%s" % env.user, *args)
 
+class Batch(object):
+    """
+    Queues up remote commands and runs them as one script, in one round trip.
+
+        with Batch(use_sudo=True) as batch:
+            batch.add('mkdir -p /foo')
+            batch.add('chown foo /foo')
+
+    The script stops at the first command that fails, and the abort (or, with
+    warn_only, the warning) says which command that was and its exit status.
+    Each command that succeeds is a step in the deploy timeline.
+    """
+    FAILURE_MARKER = 'BATCHED_COMMAND_FAILED'
+    TIME_MARKER = 'BATCHED_COMMAND_STARTED'
+
+    def __init__(self, use_sudo=False, user=None):
+        if user:
+            assert use_sudo
+        self.use_sudo = use_sudo
+        self.user = user
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, cmd):
+        self.commands.append(cmd)
+
+    def get_script(self, commands):
+        # Each command gets its own braces so that && and || inside it
+        # don't bind to the failure check. The start time of one past the
+        # last command is when the last one finished.
+        lines = []
+        for i, cmd in enumerate(commands):
+            lines.append('echo "%s %d $(date +%%s.%%N)"' % (Batch.TIME_MARKER, i))
+            lines.append('{\n%s\n} || { status=$?; echo "%s %d $status"; exit $status; }' % (cmd, Batch.FAILURE_MARKER, i))
+        lines.append('echo "%s %d $(date +%%s.%%N)"' % (Batch.TIME_MARKER, len(commands)))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def parse_times(output):
+        """Returns {index: start time} of the commands that started, plus one past the last."""
+        times = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == Batch.TIME_MARKER:
+                times[int(fields[1])] = float(fields[2])
+        return times
+
+    @staticmethod
+    def parse_failure(output):
+        """Returns (index, exit status) of the command that failed, or (None, None)."""
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == Batch.FAILURE_MARKER:
+                return int(fields[1]), int(fields[2])
+        return None, None
+
+    def execute(self):
+        if not self.commands:
+            return None
+        commands, self.commands = self.commands, []
+        runner = partial(sudo, user=self.user) if self.use_sudo else run
+        warn_only = env.warn_only
+        with settings(warn_only=True):
+            result = runner(self.get_script(commands))
+        times = Batch.parse_times(result)
+        for i, cmd in enumerate(commands):
+            if i in times and i + 1 in times:
+                Timeline.add_step(cmd, times[i], times[i + 1], Timeline.depth + 1)
+        if not result.failed:
+            return result
+        index, status = Batch.parse_failure(result)
+        if index is None:
+            status = result.return_code
+            message = "Batch of %d commands failed with exit status %s" % (len(commands), status)
+        else:
+            message = "Batched command %d of %d failed with exit status %s:\n  %s" % (
+                index + 1, len(commands), status, commands[index])
+        if warn_only:
+            warn(message)
+        else:
+            abort(message)
+        return result
+
 #
 # Stage management
 #
@@ -86,7 +363,8 @@ def stage_dev():
     env.user = os.getenv('USER')
     env.stage_name_constant = 'STAGE_NAME_DEV'
     env.stage = {
-        'hostname': 'dev.' + DOMAIN
+        'hostname': 'dev.' + DOMAIN,
+        'cached_templates': False,
     }
     env.hosts = [env.stage['hostname']]
 
@@ -94,7 +372,8 @@ def stage_staging():
     env.user = PRODUCTION_USERNAME
     env.stage_name_constant = 'STAGE_NAME_STAGING'
     env.stage = {
-        'hostname': 'staging.' + DOMAIN
+        'hostname': 'staging.' + DOMAIN,
+        'cached_templates': True,
     }
     env.hosts = [env.stage['hostname']]
 
@@ -102,7 +381,8 @@ def stage_production():
     env.user = PRODUCTION_USERNAME
     env.stage_name_constant = 'STAGE_NAME_PROD'
     env.stage = {
-        'hostname': 'www.' + DOMAIN
+        'hostname': 'www.' + DOMAIN,
+        'cached_templates': True,
     }
     env.hosts = [PRODUCTION_HOST]
 
@@ -110,43 +390,197 @@ def stage_production():
 # Tasks
 #
 
+class Host(object):
+    # One command, one line per fact, each an integer. The lines are prefixed
+    # so that anything else the login shell prints (motd, profile) is ignored.
+    FACT_PREFIX = 'HOST_FACT_'
+    FACT_COMMANDS = [
+        'echo HOST_FACT_cpus=$(grep -c ^processor /proc/cpuinfo)',
+        "echo HOST_FACT_memory_mb=$(( $(awk '/^MemTotal:/ {print $2}' /proc/meminfo) / 1024 ))",
+        'echo HOST_FACT_file_max=$(cat /proc/sys/fs/file-max)', # System-wide open files
+        'echo HOST_FACT_nr_open=$(cat /proc/sys/fs/nr_open)', # Highest per-process limit root can set
+        # 1 if any disk spins, assuming it holds the database
+        'echo HOST_FACT_rotational=$(cat /sys/block/{sd,vd,xvd,hd}*/queue/rotational 2>/dev/null | sort -r | head -1 | grep . || echo 1)',
+        'echo HOST_FACT_page_size=$(getconf PAGE_SIZE)',
+        'echo HOST_FACT_shmmax=$(cat /proc/sys/kernel/shmmax)',
+        'echo HOST_FACT_shmall=$(cat /proc/sys/kernel/shmall)',
+    ]
+    facts = {} # Per host
+    # Roles that size themselves from the host's RAM, see get_memory_mb
+    MEMORY_ROLES = ['database', 'django', 'memcached']
+
+    @staticmethod
+    def get_facts():
+        """Returns the current host's hardware facts, fetched once per host."""
+        if env.host_string not in Host.facts:
+            with hide('stdout'):
+                output = run(' ; '.join(Host.FACT_COMMANDS))
+            lines = [line.strip()[len(Host.FACT_PREFIX):] for line in output.splitlines()
+                if line.strip().startswith(Host.FACT_PREFIX)]
+            Host.facts[env.host_string] = dict((name, int(value))
+                for name, value in (line.split('=', 1) for line in lines))
+        return Host.facts[env.host_string]
+
+    @staticmethod
+    def get_memory_mb():
+        """
+        Returns the RAM each of the MEMORY_ROLES this host runs can size itself
+        from: its total, split evenly between them so they don't overcommit it.
+        """
+        roles = [role for role in HOST_ROLES.get(env.host, Host.MEMORY_ROLES) if role in Host.MEMORY_ROLES]
+        return Host.get_facts()['memory_mb'] / max(1, len(roles))
+
 class Apt(object):
+    UPDATE_STAMP = '/var/lib/apt/periodic/fabfile-update-success-stamp'
+
+    # Per host: packages known to be installed, and whether we've checked the index is fresh
+    installed = {}
+    updated = set()
+
+    @staticmethod
+    def get_installed(pkgs):
+        """Returns the set of packages known to be installed, asking dpkg about any of `pkgs` we haven't yet."""
+        installed = Apt.installed.setdefault(env.host_string, set())
+        unknown = [pkg for pkg in pkgs if pkg not in installed]
+        if unknown:
+            with settings(hide('running', 'stdout', 'warnings'), warn_only=True): # Fails if any are unknown
+                output = run("dpkg-query -W -f='${Package} ${Status}\\n' %s" % ' '.join(unknown))
+            for line in output.splitlines():
+                fields = line.split()
+                if fields[-3:] == ['install', 'ok', 'installed']:
+                    installed.add(fields[0])
+        return installed
+
     @staticmethod
     def install(*pkgs):
-        sudo('apt-get install -y %s' % ' '.join(pkgs))
+        """Installs whichever of `pkgs` are missing, in one apt-get transaction."""
+        installed = Apt.get_installed(pkgs)
+        missing = [pkg for pkg in pkgs if pkg not in installed]
+        if not missing:
+            print 'Already installed: %s' % ' '.join(pkgs)
+            return
+        Apt.update()
+        sudo('apt-get install -y %s' % ' '.join(missing))
+        installed.update(missing)
+
+    @staticmethod
+    def update(upgrade=False):
+        """
+        Runs apt-get update, and upgrade if asked, unless the package index was
+        updated less than APT_UPDATE_MAX_AGE minutes ago.
+        """
+        if env.host_string in Apt.updated:
+            return
+        commands = ['apt-get update -y'] + (['apt-get upgrade -y'] if upgrade else []) + [
+            'mkdir -p %s' % os.path.dirname(Apt.UPDATE_STAMP), 'touch %s' % Apt.UPDATE_STAMP]
+        sudo('if [ -z "$(find %s -mmin -%d 2>/dev/null)" ]; then %s; fi' % (
+            Apt.UPDATE_STAMP, APT_UPDATE_MAX_AGE, ' && '.join(commands)))
+        Apt.updated.add(env.host_string)
 
     @staticmethod
     def upgrade():
-        sudo('apt-get update -y')
-        sudo('apt-get upgrade -y')
+        Apt.update(upgrade=True)
+
+    @staticmethod
+    def add_ppa(ppa):
+        """Adds a Launchpad PPA such as 'nginx/stable', updating the package index if it's new."""
+        with settings(hide('everything'), warn_only=True):
+            if not run('grep -rqs "ppa.launchpad.net/%s/" /etc/apt/sources.list.d/' % ppa).failed:
+                return
+        Apt.install('python-software-properties') # add-apt-repository
+        sudo('add-apt-repository ppa:%s' % ppa)
+        sudo('rm -f %s' % Apt.UPDATE_STAMP)
+        Apt.updated.discard(env.host_string)
+        Apt.update()
+
+    @staticmethod
+    def configure_proxy():
+        """Points apt at APT_PROXY, if set."""
+        proxy_conf = '/etc/apt/apt.conf.d/01%s-proxy' % PROJECT_NAME
+        if APT_PROXY:
+            upload_template('./server/apt/proxy', proxy_conf, use_sudo=True, use_jinja=True, context={
+                'APT_PROXY': APT_PROXY,
+            })
+        else:
+            sudo('rm -f %s' % proxy_conf)
 
 class Pip(object):
+    REQUIREMENTS_FILE = './server/requirements.txt'
+    # Headers the packages in REQUIREMENTS_FILE build against
+    BUILD_DEPENDENCIES = ['python-dev', 'libpq-dev', 'libmemcached-dev', 'zlib1g-dev']
+
     @staticmethod
     def install_virtualenv():
         sudo('pip install virtualenv')
 
     @staticmethod
     def install(*pkgs):
-        pip =  os.path.join(VIRTUALENV, 'bin', 'pip')
+        # Note this changes the virtualenv the live release is using
+        pip =  os.path.join(PROJECT_DIR, 'current', 'env', 'bin', 'pip')
         for pkg in pkgs:
             run('%s install -U %s' % (pip, pkg))
 
+    @staticmethod
+    def get_requirements_hash():
+        return hashlib.md5(open(Pip.REQUIREMENTS_FILE).read()).hexdigest()
+
+    @staticmethod
+    def get_virtualenv_dir(requirements_hash=None):
+        requirements_hash = requirements_hash or Pip.get_requirements_hash()
+        return '%s-%s' % (VIRTUALENV, requirements_hash[:12])
+
     @staticmethod
     def install_requirements():
+        """
+        Makes sure there's a virtualenv built from the current requirements
+        file and returns its path.
+
+        There's one virtualenv per hash of the requirements file, so an
+        unchanged file costs nothing and a changed one gets a fresh virtualenv
+        instead of modifying the one the live release is using. Packages are
+        built as wheels into PROJECT_DIR/packages/wheels, which is reused
+        across builds.
+        """
+        ve_dir = Pip.get_virtualenv_dir()
+        complete_marker = os.path.join(ve_dir, '.complete')
+        if exists(complete_marker):
+            print 'Virtualenv %s is up to date' % ve_dir
+            return ve_dir
+        # Here rather than in install_*, so hosts that only ever deploy have them too
+        Apt.install(*Pip.BUILD_DEPENDENCIES)
+        if exists(ve_dir): # Left over from an interrupted build
+            sudo('rm -rf %s' % ve_dir)
+        sudo('mkdir -p %s' % ve_dir)
+        set_up_permissions(ve_dir)
+        run('virtualenv %s' % ve_dir)
+
         REMOTE_FILENAME = './tmp_requirements.txt'
-        pip =  os.path.join(VIRTUALENV, 'bin', 'pip')
-        put('./server/requirements.txt', REMOTE_FILENAME)
-        run('%s install -r %s' % (pip, REMOTE_FILENAME))
+        pip =  os.path.join(ve_dir, 'bin', 'pip')
+        wheel_dir = os.path.join(PROJECT_DIR, 'packages', 'wheels')
+        put(Pip.REQUIREMENTS_FILE, REMOTE_FILENAME)
+        run('%s install wheel' % pip)
+        run('%s wheel --wheel-dir=%s --find-links=%s -r %s' % (pip, wheel_dir, wheel_dir, REMOTE_FILENAME))
+        run('%s install --no-index --find-links=%s -r %s' % (pip, wheel_dir, REMOTE_FILENAME))
         run('rm %s' % REMOTE_FILENAME)
+        run('touch %s' % complete_marker)
+        return ve_dir
 
-def set_up_permissions(dirname):
-    sudo('chown -R %s:%s %s' % (env.user, SERVER_GROUP, dirname))
-    sudo('chmod -R g+w %s' % dirname)
+def set_up_permissions(dirname, batch=None):
+    with Batch(use_sudo=True) as own_batch:
+        batch = batch or own_batch
+        assert batch.use_sudo
+        batch.add('chown -R %s:%s %s' % (env.user, SERVER_GROUP, dirname))
+        batch.add('chmod -R g+w %s' % dirname)
 
-def adduser(username):
+def adduser(username, batch=None):
     # Idempotent (non-failing) version of adduser
     base_cmd = 'useradd --user-group %s' % username
-    sudo(base_cmd + ' || [[ $? == 9 ]]') # 9 is failure code for already exists
+    cmd = base_cmd + ' || [[ $? == 9 ]]' # 9 is failure code for already exists
+    if batch:
+        assert batch.use_sudo
+        batch.add(cmd)
+    else:
+        sudo(cmd)
     # alt: getent passwd username || useradd, also thanks to \amethyst
 
 def bootstrap_everything():
@@ -154,38 +588,73 @@ def bootstrap_everything():
     install_common()
     install_nginx()
     install_database()
+    install_pooler()
+    install_memcached()
     install_django()
     install_smtp()
-    configure_nginx()
-    configure_django()
-    configure_database()
-    configure_smtp()
-    restart_database() # Must be done before deploy so that syncdb works
-    simple_deploy()
-    restart_database()
-    restart_django() # Must be done before nginx so that port 80 is free
-    restart_nginx()
-    restart_smtp()
+    nginx_changed = configure_nginx()
+    django_changed = configure_django()
+    database_changed = configure_database()
+    pooler_changed = configure_pooler()
+    memcached_changed = configure_memcached()
+    smtp_changed = configure_smtp()
+    if database_changed:
+        restart_database() # Must be done before deploy so that syncdb works
+    if pooler_changed or database_changed:
+        restart_pooler() # Likewise, since Django connects through it
+    if django_changed:
+        # A rolling restart only restarts the daemon processes, so Apache has to
+        # load a new vhost and ports.conf (and free port 80 for nginx) itself
+        restart_django()
+    simple_deploy() # Restarts django, which must be done before nginx so that port 80 is free
+    if nginx_changed:
+        restart_nginx()
+    if memcached_changed:
+        restart_memcached()
+    if smtp_changed:
+        restart_smtp()
 
 def bootstrap_database():
     install_common()
     install_database()
-    configure_database()
-    restart_database()
+    if configure_database():
+        restart_database()
+
+def bootstrap_pooler():
+    install_common()
+    install_pooler()
+    if configure_pooler():
+        restart_pooler()
+
+def bootstrap_memcached():
+    install_common()
+    install_memcached()
+    if configure_memcached():
+        restart_memcached()
+
+def _bootstrap_local_memcached():
+    """Sets up memcached on this host too, if MEMCACHED_HOSTS has a node on 127.0.0.1."""
+    if set(MEMCACHED_HOSTS) & set(['127.0.0.1', 'localhost']):
+        install_memcached()
+        if configure_memcached():
+            restart_memcached()
 
 def bootstrap_nginx():
     install_common()
     install_nginx()
-    configure_nginx()
+    _bootstrap_local_memcached()
+    nginx_changed = configure_nginx()
     deploy()
-    restart_nginx()
+    if nginx_changed:
+        restart_nginx()
 
 def bootstrap_django():
     install_common()
     install_django()
+    _bootstrap_local_memcached()
     configure_django()
     deploy()
-    restart_django()
+    restart_django() # Needed for the new release whether or not the config changed
 
 def bootstrap_smtp():
     install_common()
@@ -197,6 +666,7 @@ def install_common():
     # and use it next time.
     #put('./server/grub_preseed.cfg', 'grub_preseed.cfg')
     #sudo('debconf-set-selections grub_preseed.cfg')
+    Apt.configure_proxy()
     Apt.upgrade()
     sudo('echo LANG=\\"en_US.UTF-8\\" > /etc/default/locale')
     locale_env = [
@@ -207,16 +677,16 @@ def install_common():
     Apt.install('python-setuptools', 'python-pycurl', 'vim', 'screen', 'language-pack-en', 'git-core',
             'subversion', 'cron', 'curl', 'man', 'build-essential', 'python-dev', 'libpq-dev',
             'python-psycopg2', 'libcurl4-gnutls-dev', 'debconf-utils', 'ntp', 'ack-grep',
-            'memcached', 'python-memcache', # TODO: use a different memcached client
             )
-    sudo('easy_install -U setuptools')
-    sudo('easy_install pip')
-    adduser(SERVER_GROUP)
-    for dirname in ['releases', 'packages', 'bin', 'log']:
-        sudo('mkdir -p %s' % os.path.join(PROJECT_DIR, dirname))
-    set_up_permissions('/project')
-    log_dir = os.path.join(PROJECT_DIR, 'log')
-    sudo('chmod g+s %s' % log_dir)
+    with Batch(use_sudo=True) as batch:
+        batch.add('easy_install -U setuptools')
+        batch.add('easy_install pip')
+        adduser(SERVER_GROUP, batch)
+        batch.add('mkdir -p %s' % ' '.join(os.path.join(PROJECT_DIR, dirname)
+            for dirname in ['releases', 'packages', 'bin', 'log']))
+        set_up_permissions('/project', batch)
+        log_dir = os.path.join(PROJECT_DIR, 'log')
+        batch.add('chmod g+s %s' % log_dir)
     install_keys()
 
 def _key_destination(public=True):
@@ -231,7 +701,6 @@ def install_keys():
     # if you don't want that.
     put('./server/id_rsa', _key_destination(public=False))
     put('./server/id_rsa.pub', _key_destination())
-    run('chmod 600 %s' % _key_destination(public=False))
 
     # So we can git clone from git@github.com w/o manual confirmation:
     put('./server/known_hosts', home_dir('.ssh/known_hosts'))
@@ -247,36 +716,35 @@ def install_keys():
     # Multiple projects will have the same HostName line.
     # We can't make the lines unique with a comment because ssh chokes; wants comments on their own line.
     # Therefore, just append for now until something needs to change. (SSH uses first match.)
-    for l in lines:
-        assert "'" not in l
-        run("echo '%s' >> %s" % (l, config_file))
-        run("echo '%s' >> %s" % ('', config_file))
+    with Batch() as batch:
+        batch.add('chmod 600 %s' % _key_destination(public=False))
+        for l in lines:
+            assert "'" not in l
+            batch.add("echo '%s' >> %s" % (l, config_file))
+            batch.add("echo '%s' >> %s" % ('', config_file))
 
 def install_nginx():
+    if NGINX_PPA:
+        Apt.add_ppa(NGINX_PPA)
     Apt.install('nginx')
     assert exists('/etc/nginx/sites-enabled') # Right package install format?
     if exists('/etc/nginx/sites-enabled/default'):
         sudo('rm /etc/nginx/sites-enabled/default')
 
-#def install_processor():
-#    """
-#    Stuff to compile javascript
-#    """
-#    put('./server/processor/compiler.jar', os.path.join(PROJECT_DIR, 'bin', 'compiler.jar'))
-#    put('./server/processor/processor', os.path.join(PROJECT_DIR, 'bin', 'processor'))
-
 def install_django():
     Pip.install_virtualenv()
-    if not exists(VIRTUALENV): # TODO: better test than `exists`?
-        sudo('mkdir -p %s' % VIRTUALENV)
-        sudo('virtualenv %s' % VIRTUALENV)
-    set_up_permissions(VIRTUALENV)
     Pip.install_requirements()
-    Apt.install('apache2', 'postgresql-client', 'libapache2-mod-wsgi')
+    Apt.install('apache2', 'postgresql-client', 'libapache2-mod-wsgi', 'python-memcache')
     if exists('/etc/apache2/sites-enabled/000-default'):
         sudo('rm /etc/apache2/sites-enabled/000-default')
     sudo('usermod -G %s -a www-data' % SERVER_GROUP)
 
+def install_pooler():
+    Apt.install('pgbouncer')
+
+def install_memcached():
+    Apt.install('memcached')
+
 def install_smtp():
     # this next line is really configuration, but it has to happen before installing
     # the package or else it will prompt for configuration
@@ -293,47 +761,145 @@ def install_database():
     Apt.install('postgresql')
     restart_database()
 
-def configure_nginx():
-    put('./server/nginx/nginx.conf', '/etc/nginx/nginx.conf', use_sudo=True)
-    upload_template( './server/nginx/site', '/etc/nginx/sites-available/%s' % PROJECT_NAME, 
+def _report_config_change(service, changed):
+    print '%s configuration %s' % (service, 'changed' if changed else 'unchanged')
+    return changed
+
+def _nginx_tuning():
+    """Returns the nginx.conf context, sized from the host's CPUs, RAM and open file limits."""
+    facts = Host.get_facts()
+    workers = facts['cpus']
+    # Leave most of the system-wide file table to everything else on the host
+    nofile = max(1024, min(65536, facts['nr_open'], facts['file_max'] / 4 / workers))
+    # A proxied request holds two descriptors (client and Apache) and, at worst,
+    # around 64k of buffers; let connections use up to a quarter of RAM
+    by_memory = facts['memory_mb'] * 1024 / 4 / 64 / workers
+    tuning = {
+        'worker_processes': workers,
+        'worker_rlimit_nofile': nofile,
+        'worker_connections': max(512, min(nofile / 2, by_memory)),
+        'open_file_cache_max': min(10000, nofile / 4),
+        'proxy_buffers': facts['memory_mb'] >= 4096 and 32 or facts['memory_mb'] >= 1024 and 16 or 8,
+    }
+    print '%s: nginx %s' % (env.host_string, ', '.join('%s %s' % item for item in sorted(tuning.items())))
+    return tuning
+
+def _nginx_version():
+    with hide('running', 'stdout'):
+        output = sudo('nginx -v 2>&1')
+    match = re.search(r'nginx/(\d+)\.(\d+)\.(\d+)', output)
+    return tuple(int(part) for part in match.groups()) if match else (0, 0, 0)
+
+def _django_backends(local_only=False):
+    """
+    Returns DJANGO_BACKENDS as (host, port) pairs. With local_only, just the
+    ones served by Apache on the current host.
+    """
+    backends = [(backend.rsplit(':', 1)[0], int(backend.rsplit(':', 1)[1])) for backend in DJANGO_BACKENDS]
+    if local_only:
+        backends = [(host, port) for host, port in backends if host in ('127.0.0.1', 'localhost', env.host)]
+    return backends
+
+def _upload_nginx_site(down=()):
+    """Renders the site with the `down` backends out of rotation; returns whether it changed."""
+    version = _nginx_version()
+    keepalive = NGINX_UPSTREAM_KEEPALIVE
+    if keepalive and version < (1, 1, 4):
+        print '%s: nginx is older than 1.1.4, so no upstream keepalive (see NGINX_PPA)' % env.host_string
+        keepalive = 0
+    return upload_template( './server/nginx/site', '/etc/nginx/sites-available/%s' % PROJECT_NAME, 
             use_sudo=True, use_jinja=True, context={
         'hostname': env.stage['hostname'],
-        'django_host': '127.0.0.1', # Change this on switch to a multi-server setup
-        'DJANGO_PORT': DJANGO_PORT,
+        'backends': ['%s:%d' % backend for backend in _django_backends()],
+        'down': ['%s:%d' % backend for backend in down],
+        'least_conn': version >= (1, 3, 1),
         'DOMAIN': DOMAIN,
-        'PROJECT_NAME': PROJECT_NAME
+        'PROJECT_NAME': PROJECT_NAME,
+        'upstream_keepalive': keepalive,
     })
+
+def configure_nginx():
+    """Returns whether any nginx configuration changed."""
+    changed = upload_template('./server/nginx/nginx.conf', '/etc/nginx/nginx.conf', use_sudo=True,
+        use_jinja=True, context=_nginx_tuning())
+    changed |= _upload_nginx_site()
     if not exists('/etc/nginx/sites-enabled/%s' % PROJECT_NAME):
         sudo('ln -s /etc/nginx/sites-available/%s /etc/nginx/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+        changed = True
+    return _report_config_change('nginx', changed)
+
+def _wsgi_pool_size(backends=1):
+    """
+    Returns (processes, threads) for each of `backends` mod_wsgi daemons;
+    processes are bounded by both CPUs and RAM, and shared between backends.
+    """
+    facts = Host.get_facts()
+    memory_mb = Host.get_memory_mb()
+    processes = WSGI_PROCESSES
+    if not processes:
+        by_memory = int(memory_mb * WSGI_MEMORY_FRACTION / WSGI_PROCESS_MEMORY_MB)
+        processes = min(facts['cpus'] * 2, by_memory)
+    processes = max(1, processes / backends)
+    print '%s: %d mod_wsgi backend(s) of %d processes x %d threads, recycled every %d requests (%d CPUs, %d MB RAM for Django)' % (
+        env.host_string, backends, processes, WSGI_THREADS, WSGI_MAXIMUM_REQUESTS, facts['cpus'], memory_mb)
+    return processes, WSGI_THREADS
 
 def configure_django():
-    upload_template('./server/django/wsgi.py', os.path.join(PROJECT_DIR, 'wsgi.py'), use_jinja=True, context={
+    """Returns whether any Apache/mod_wsgi/Django stage configuration changed."""
+    batch = Batch(use_sudo=True)
+    changed = upload_template('./server/django/wsgi.py', os.path.join(PROJECT_DIR, 'wsgi.py'), batch=batch, use_jinja=True, context={
         'PROJECT_NAME': PROJECT_NAME,
         'PYTHON_VERSION_STR': "%d.%d" % PYTHON_VERSION,
     })
-    upload_template('./server/django/vhost', '/etc/apache2/sites-available/%s' % PROJECT_NAME, use_sudo=True, use_jinja=True, context={
-        'DJANGO_PORT': DJANGO_PORT,
+    backends = _django_backends(local_only=True)
+    ports = [port for host, port in backends]
+    if not ports:
+        abort("None of DJANGO_BACKENDS is on %s; list it, or 127.0.0.1, there" % env.host)
+    processes, threads = _wsgi_pool_size(len(ports))
+    changed |= upload_template('./server/django/vhost', '/etc/apache2/sites-available/%s' % PROJECT_NAME, batch=batch, use_sudo=True, use_jinja=True, context={
+        'ports': ports,
         'PROJECT_NAME': PROJECT_NAME,
         'DOMAIN': DOMAIN, # Should we use env.stage['hostname']?
-        'ADMIN_EMAIL': ADMIN_EMAIL
-
+        'ADMIN_EMAIL': ADMIN_EMAIL,
+        'WSGI_PROCESSES': processes,
+        'WSGI_THREADS': threads,
+        'WSGI_MAXIMUM_REQUESTS': WSGI_MAXIMUM_REQUESTS,
     })
-    upload_template('./server/django/ports.conf', '/etc/apache2/ports.conf', use_sudo=True, use_jinja=True, context={
-        'DJANGO_PORT': DJANGO_PORT,
+    changed |= upload_template('./server/django/ports.conf', '/etc/apache2/ports.conf', batch=batch, use_sudo=True, use_jinja=True, context={
+        'backends': backends,
     })
-    upload_template('./server/django/stagesettings.py', os.path.join(PROJECT_DIR, 'stagesettings.py'), use_sudo=True, 
+    changed |= upload_template('./server/django/stagesettings.py', os.path.join(PROJECT_DIR, 'stagesettings.py'), batch=batch, use_sudo=True, 
         use_jinja=True, context={
         'database_host': '127.0.0.1', # Change this on swtich to a multi-server setup
+        'database_port': POOLER_PORT or '',
+        'PROJECT_NAME': PROJECT_NAME,
+        'DB_PASS': DB_PASS,
         'STAGE_NAME_CONSTANT': env.stage_name_constant,
-
+        'cached_templates': env.stage.get('cached_templates', False),
+        'cache_backend': {
+            'pylibmc': 'common.cache.BinaryPyLibMCCache',
+            'python-memcached': 'django.core.cache.backends.memcached.MemcachedCache',
+        }[MEMCACHED_CLIENT],
+        'cache_locations': ['%s:%d' % (host, MEMCACHED_PORT) for host in MEMCACHED_HOSTS],
+    })
+    # Log rotation doesn't need a restart, so doesn't count as a change
+    upload_template('./server/logrotate/django', '/etc/logrotate.d/%s' % PROJECT_NAME, batch=batch, use_sudo=True,
+        use_jinja=True, context={
+        'PROJECT_NAME': PROJECT_NAME,
     })
     if not exists('/etc/apache2/sites-enabled/%s' % PROJECT_NAME):
-        sudo('ln -s /etc/apache2/sites-available/%s /etc/apache2/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+        batch.add('ln -s /etc/apache2/sites-available/%s /etc/apache2/sites-enabled/%s' % (PROJECT_NAME, PROJECT_NAME))
+        changed = True
+    batch.execute()
+    return _report_config_change('django', changed)
 
 def configure_smtp():
+    """Returns whether the postfix configuration changed."""
     main_cf = '/etc/postfix/main.cf'
+    changed = not contains(main_cf, "inet_interfaces = loopback-only")
     comment(main_cf, "^inet_interfaces = all$", use_sudo=True)
     append(main_cf, "inet_interfaces = loopback-only", use_sudo=True)
+    return _report_config_change('smtp', changed)
 
 def run_with_safe_error(cmd, safe_error, use_sudo=False, user=None):
     # Todo: use _run_command in 1.0
@@ -358,19 +924,80 @@ def run_with_safe_error(cmd, safe_error, use_sudo=False, user=None):
             )
 
 def configure_database():
+    """Returns whether any Postgres configuration changed."""
     config_dir = '/etc/postgresql/%d.%d/main' % PG_VERSION
     sudo('mkdir -p %s' % config_dir)
-    for filename in ['environment', 'pg_ctl.conf', 'pg_hba.conf', 'pg_ident.conf', 'postgresql.conf', 'start.conf']:
-        local_file = os.path.join('./server/database', filename)
-        remote_file = os.path.join(config_dir, filename)
-        upload_template( local_file, remote_file, use_sudo=True, use_jinja=True, context={
-            'PROJECT_NAME': PROJECT_NAME,
-            'PG_VERSION_STRING': "%d.%d" % PG_VERSION,
-        })
-        sudo('chown %s:%s %s' % ('postgres', 'postgres', remote_file))
+    filenames = ['environment', 'pg_ctl.conf', 'pg_hba.conf', 'pg_ident.conf', 'postgresql.conf', 'start.conf']
+    remote_files = [os.path.join(config_dir, filename) for filename in filenames]
+    md5s = _remote_md5sums(remote_files + [Postgres.SHM_SYSCTL_FILE], use_sudo=True)
+    tuning = Postgres.get_tuning()
+    context = dict(tuning, PROJECT_NAME=PROJECT_NAME, PG_VERSION_STRING="%d.%d" % PG_VERSION)
+    changed = False
+    with Batch(use_sudo=True) as batch:
+        # The kernel has to allow shared_buffers before Postgres restarts with it
+        if upload_template('./server/sysctl/postgresql-shm.conf', Postgres.SHM_SYSCTL_FILE, batch=batch,
+                remote_md5s=md5s, use_sudo=True, use_jinja=True, context=tuning):
+            batch.add('sysctl -p %s' % Postgres.SHM_SYSCTL_FILE)
+        for filename, remote_file in zip(filenames, remote_files):
+            local_file = os.path.join('./server/database', filename)
+            if upload_template( local_file, remote_file, batch=batch, remote_md5s=md5s, use_sudo=True,
+                    use_jinja=True, context=context):
+                batch.add('chown %s:%s %s' % ('postgres', 'postgres', remote_file))
+                changed = True
     run_with_safe_error("createdb %s" % PROJECT_NAME, 'some dumb error', use_sudo=True, user='postgres')
     run_with_safe_error("""psql -c "create user %s with createdb encrypted password '%s'" """ % (PROJECT_NAME, DB_PASS), "some dumb error", use_sudo=True, user='postgres')
     sudo("""psql -c "grant all privileges on database %s to %s" """ % (PROJECT_NAME, PROJECT_NAME), user='postgres')
+    return _report_config_change('database', changed)
+
+def _pooler_sizes():
+    """Returns pgbouncer's pool sizes, fitted to the max_connections configure_database gives Postgres."""
+    # Leave room for superusers (superuser_reserved_connections), cron jobs and psql sessions
+    budget = max(2, Postgres.get_tuning()['max_connections'] - 10)
+    default_pool_size = max(1, budget * 3 / 4)
+    sizes = {
+        'default_pool_size': default_pool_size,
+        'reserve_pool_size': budget - default_pool_size,
+        # Clients are cheap, but each needs a file descriptor within the default limit of 1024
+        'max_client_conn': max(100, min(1000 - budget, budget * 20)),
+    }
+    print '%s: pgbouncer %s' % (env.host_string, ', '.join('%s %s' % item for item in sorted(sizes.items())))
+    return sizes
+
+def configure_pooler():
+    """Returns whether the pgbouncer configuration changed."""
+    files = [
+        ('./server/pooler/pgbouncer.ini', '/etc/pgbouncer/pgbouncer.ini'),
+        ('./server/pooler/userlist.txt', '/etc/pgbouncer/userlist.txt'),
+        ('./server/pooler/default', '/etc/default/pgbouncer'),
+    ]
+    md5s = _remote_md5sums([remote_file for local_file, remote_file in files], use_sudo=True)
+    context = dict(_pooler_sizes(), PROJECT_NAME=PROJECT_NAME, DB_PASS=DB_PASS, POOLER_PORT=POOLER_PORT or 6432)
+    changed = False
+    with Batch(use_sudo=True) as batch:
+        for local_file, remote_file in files:
+            changed |= upload_template(local_file, remote_file, batch=batch, remote_md5s=md5s, use_sudo=True,
+                use_jinja=True, context=context)
+        # Holds the database password
+        batch.add('chown postgres:postgres /etc/pgbouncer/userlist.txt')
+        batch.add('chmod 640 /etc/pgbouncer/userlist.txt')
+    return _report_config_change('pooler', changed)
+
+def configure_memcached():
+    """Returns whether the memcached configuration changed."""
+    facts = Host.get_facts()
+    memory_mb = MEMCACHED_MEMORY_MB or max(64, int(Host.get_memory_mb() * MEMCACHED_MEMORY_FRACTION))
+    context = {
+        'memory_mb': memory_mb,
+        'threads': facts['cpus'],
+        # Idle connections are a few kB each; memcached raises its own file limit to match
+        'connections': min(facts['nr_open'] / 2, max(1024, facts['memory_mb'] * 4)),
+        'listen': env.host if env.host in MEMCACHED_HOSTS else '127.0.0.1',
+        'MEMCACHED_PORT': MEMCACHED_PORT,
+    }
+    print '%s: memcached %s' % (env.host_string, ', '.join('%s %s' % item for item in sorted(context.items())))
+    changed = upload_template('./server/memcached/memcached.conf', '/etc/memcached.conf', use_sudo=True,
+        use_jinja=True, context=context)
+    return _report_config_change('memcached', changed)
 
 def make_symlink_atomically(new_target, symlink_location, sudo=False):
     # From http://blog.moertel.com/articles/2005/08/22/how-to-change-symlinks-atomically
@@ -383,6 +1010,60 @@ def make_symlink_atomically(new_target, symlink_location, sudo=False):
     cmd = "ln -s %(new_target)s %(tempname)s && mv -Tf %(tempname)s %(symlink_location)s" % params
     runner(cmd)
 
+class Postgres(object):
+    SHM_SYSCTL_FILE = '/etc/sysctl.d/30-postgresql-shm.conf' # Replaces the one the package installs
+
+    # Per PG_PROFILE: max_connections per CPU and its floor, how many work_mem
+    # sorts/hashes a connection may run at once, the share of RAM for
+    # maintenance (vacuum, index builds), and checkpoint spacing. Reporting
+    # queries are few and big; web ones many and small.
+    PROFILES = {
+        'web': {'connections_per_cpu': 10, 'min_connections': 100, 'sorts_per_connection': 4,
+            'maintenance_ram_share': 16, 'checkpoint_segments': 16, 'checkpoint_timeout': '5min',
+            'checkpoint_completion_target': 0.7},
+        'mixed': {'connections_per_cpu': 6, 'min_connections': 60, 'sorts_per_connection': 2,
+            'maintenance_ram_share': 16, 'checkpoint_segments': 32, 'checkpoint_timeout': '10min',
+            'checkpoint_completion_target': 0.9},
+        'reporting': {'connections_per_cpu': 3, 'min_connections': 30, 'sorts_per_connection': 1,
+            'maintenance_ram_share': 8, 'checkpoint_segments': 64, 'checkpoint_timeout': '15min',
+            'checkpoint_completion_target': 0.9},
+    }
+
+    @staticmethod
+    def get_tuning():
+        """Returns postgresql.conf and shared memory settings for this host and PG_PROFILE."""
+        if PG_PROFILE not in Postgres.PROFILES:
+            abort("PG_PROFILE must be one of %s" % ', '.join(sorted(Postgres.PROFILES)))
+        profile = Postgres.PROFILES[PG_PROFILE]
+        facts = Host.get_facts()
+        memory_mb = Host.get_memory_mb()
+        ssd = PG_SSD if PG_SSD is not None else not facts['rotational']
+        # Beyond about 8GB, more shared_buffers stops helping; the OS cache does the rest
+        shared_buffers_mb = max(32, min(memory_mb / 4, 8192))
+        max_connections = max(profile['min_connections'], profile['connections_per_cpu'] * facts['cpus'])
+        work_mem_mb = max(1, (memory_mb - shared_buffers_mb) / (max_connections * profile['sorts_per_connection']))
+        wal_buffers_kb = 16 * 1024 if shared_buffers_mb >= 512 else max(64, shared_buffers_mb * 1024 / 32)
+        # Room for shared_buffers plus Postgres' other shared memory; never lowered
+        shmmax = max(facts['shmmax'], (shared_buffers_mb * 5 / 4 + 128) * 1024 * 1024)
+        tuning = {
+            'max_connections': max_connections,
+            'shared_buffers': '%dMB' % shared_buffers_mb,
+            'effective_cache_size': '%dMB' % (memory_mb * 3 / 4),
+            'work_mem': '%dMB' % work_mem_mb,
+            'maintenance_work_mem': '%dMB' % max(16, min(1024, memory_mb / profile['maintenance_ram_share'])),
+            'wal_buffers': '%dkB' % wal_buffers_kb,
+            'checkpoint_segments': profile['checkpoint_segments'],
+            'checkpoint_timeout': profile['checkpoint_timeout'],
+            'checkpoint_completion_target': profile['checkpoint_completion_target'],
+            'random_page_cost': 1.1 if ssd else 4.0,
+            'shmmax': shmmax,
+            'shmall': max(facts['shmall'], shmmax / facts['page_size']),
+        }
+        print '%s: Postgres %s profile for %d CPUs, %d MB RAM for Postgres, %s: %s' % (env.host_string, PG_PROFILE,
+            facts['cpus'], memory_mb, 'SSD' if ssd else 'spinning disk',
+            ', '.join('%s %s' % item for item in sorted(tuning.items())))
+        return tuning
+
 class Deploy(object):
 
     run_time = time.time()
@@ -405,6 +1086,8 @@ class Deploy(object):
         new_target = os.path.join(PROJECT_DIR, 'releases', name)
         symlink_location = os.path.join(PROJECT_DIR, 'current')
         make_symlink_atomically(new_target, symlink_location)
+        Releases.mark_activated(name)
+        Releases.prune()
 
     @staticmethod
     def get_release_dir(name):
@@ -415,6 +1098,24 @@ class Deploy(object):
     def get_git_repo():
         return GIT_CLONE_USERNAME + '@' + GIT_CLONE_PSEUDOHOST + ':' + GIT_CLONE_PATH
  
+    @staticmethod
+    def get_mirror_dir():
+        return os.path.join(PROJECT_DIR, 'repo.git')
+
+    @staticmethod
+    def update_mirror():
+        """
+        Brings the bare mirror of the git repo up to date, creating it if
+        needed. Only objects we don't have yet come over the network.
+        """
+        mirror_dir = Deploy.get_mirror_dir()
+        if not exists(os.path.join(mirror_dir, 'HEAD')):
+            run('git clone --mirror %s %s' % (Deploy.get_git_repo(), mirror_dir))
+            set_up_permissions(mirror_dir)
+        else:
+            with cd(mirror_dir):
+                run('git fetch --prune origin')
+ 
     @staticmethod
     def upload_new_release():
         name = Deploy.get_release_name()
@@ -422,11 +1123,16 @@ class Deploy(object):
         if exists(release_dir):
             assert release_dir.startswith(os.path.join(PROJECT_DIR, 'releases'))
             run('rm -rf %s' % release_dir)
-        run('git clone %s %s' % (Deploy.get_git_repo(), release_dir))
-        set_up_permissions(release_dir)
+        Deploy.update_mirror()
+        # A local clone hardlinks the mirror's object files instead of copying
+        # them, and unlike --shared it keeps working if the mirror later prunes
+        # the objects an old release was built from.
+        run('git clone --local --no-checkout %s %s' % (Deploy.get_mirror_dir(), release_dir))
         current_commit = Deploy.get_current_commit()
         with cd(release_dir):
             run('git reset --hard %s' % current_commit)
+        # After the checkout, so the files it wrote get group write too
+        set_up_permissions(release_dir)
         return name
 
     @staticmethod
@@ -436,32 +1142,32 @@ class Deploy(object):
         release_dir = Deploy.get_release_dir(name)
         django_dir = os.path.join(release_dir, PROJECT_NAME)
 
-        # If you run a preprocessor, like JS/CSS compilation, do that here, e.g. :
-        #run(os.path.join(PROJECT_DIR, 'bin', 'processor') + ' ' + release_dir)
-            
         if os.path.exists('localsettings.py'):
             print 'Found localsettings.py, uploading'
             put('localsettings.py', PROJECT_DIR)
 
-        print 'Setting up Django settings symlinks'
-        with cd(django_dir):
-            run('ln -nfs %s .' % os.path.join(PROJECT_DIR, 'stagesettings.py'))
-            run('ln -nfs %s .' % os.path.join(PROJECT_DIR, 'localsettings.py'))
+        virtualenv_dir = Pip.install_requirements()
 
-        print 'Doing Django database updates'
+        print 'Linking virtualenv and settings, doing Django database updates, installing crontab'
         with cd(django_dir):
-            with_ve =  'source ' + os.path.join(VIRTUALENV, 'bin', 'activate') + ' && '
-            run(with_ve + 'python manage.py syncdb --noinput')
-            run(with_ve + 'python manage.py migrate --noinput')
-            run(with_ve + 'python manage.py loaddata initial_data')
-            run(with_ve + 'python manage.py collectstatic --noinput')
-            
+            with Batch() as batch:
+                batch.add('ln -nfs %s %s' % (virtualenv_dir, os.path.join(release_dir, 'env')))
+                batch.add('ln -nfs %s .' % os.path.join(PROJECT_DIR, 'stagesettings.py'))
+                batch.add('ln -nfs %s .' % os.path.join(PROJECT_DIR, 'localsettings.py'))
 
-        print 'Installing crontab'
-        crontab_path = os.path.join(release_dir, 'server/crontab')
-        # need to use the stdin formulation. For some reason the path in the normal form
-        # gets truncated.
-        run('crontab - < %s' % crontab_path)
+                batch.add('source ' + os.path.join(release_dir, 'env', 'bin', 'activate'))
+                # Builds the JS/CSS bundles into static/, so collectstatic picks them up
+                batch.add('python %s %s %s %s' % (os.path.join(release_dir, 'server', 'processor', 'processor'),
+                    release_dir, PROJECT_NAME, os.path.join(PROJECT_DIR, 'current')))
+                # syncdb, migrate, loaddata and collectstatic, in one Django process
+                batch.add('python manage.py prep_release --previous=%s' % os.path.join(PROJECT_DIR, 'current'))
+
+                crontab_path = os.path.join(release_dir, 'server/crontab')
+                # need to use the stdin formulation. For some reason the path in the normal form
+                # gets truncated.
+                batch.add('crontab - < %s' % crontab_path)
+
+        Releases.record(name)
 
     @staticmethod
     def cleanup_release(name):
@@ -470,10 +1176,152 @@ class Deploy(object):
             local('rm %s' % pkg_filename)
 
 
-def list_releases():
-    with cd(os.path.join(PROJECT_DIR, 'releases')):
-        run('''ls -ltc | grep -v total | awk '{print $6 " " $7 " " $8}' | head -n 10''')
-        #run('ls -l %s | cut -d " " -f "10"' % os.path.join(PROJECT_DIR, CURRENT_RELEASE_DIR))
+class Releases(object):
+    """
+    Keeps an index of the releases on a host in PROJECT_DIR/releases.json,
+    plus a release.json in each release dir, so listing and pruning releases
+    doesn't have to scan the releases dir.
+    """
+    CURRENT_MARKER = '--current--'
+
+    @staticmethod
+    def get_index_file():
+        return os.path.join(PROJECT_DIR, 'releases.json')
+
+    @staticmethod
+    def read_index():
+        """Returns (list of release metadata, name of the current release)."""
+        with hide('running', 'stdout'):
+            output = run('cat %s 2>/dev/null; echo %s; readlink %s; true' % (Releases.get_index_file(),
+                Releases.CURRENT_MARKER, os.path.join(PROJECT_DIR, 'current')))
+        index, current = output.split(Releases.CURRENT_MARKER)
+        current = os.path.basename(current.strip()) or None
+        if not index.strip():
+            return Releases.rebuild_index(), current
+        return json.loads(index), current
+
+    @staticmethod
+    def rebuild_index():
+        """Recreates the index from the release dir names, e.g. for releases made before it existed."""
+        with hide('running', 'stdout'):
+            output = run('ls -1 %s' % os.path.join(PROJECT_DIR, 'releases'))
+        releases = []
+        for name in sorted(output.split()):
+            time_str, _, commit = name.partition('_')
+            releases.append({'name': name, 'commit': commit, 'deployed_at': time_str})
+        Releases.write_index(releases)
+        return releases
+
+    @staticmethod
+    def write_index(releases):
+        index_file = Releases.get_index_file()
+        put(StringIO(json.dumps(releases, indent=1)), index_file + '.tmp')
+        run('mv %s.tmp %s' % (index_file, index_file))
+
+    @staticmethod
+    def write_metadata(release):
+        put(StringIO(json.dumps(release, indent=1)),
+            os.path.join(Deploy.get_release_dir(release['name']), 'release.json'))
+
+    @staticmethod
+    def record(name):
+        """Adds a freshly prepped release to the index."""
+        manifest = os.path.join(Deploy.get_release_dir(name), 'static_manifest.json') # Coupled w/settings.STATIC_MANIFEST
+        with hide('running', 'stdout'):
+            manifest_bytes = run('stat -c %%s %s 2>/dev/null || echo 0' % manifest)
+        release = {
+            'name': name,
+            'commit': Deploy.get_current_commit(),
+            'deployed_at': Deploy.get_time_str(),
+            'requirements_hash': Pip.get_requirements_hash(),
+            'static_manifest_bytes': int(manifest_bytes.split()[-1]),
+            'activated_at': None,
+        }
+        releases, current = Releases.read_index()
+        Releases.write_metadata(release)
+        Releases.write_index([r for r in releases if r['name'] != name] + [release])
+
+    @staticmethod
+    def mark_activated(name):
+        releases, current = Releases.read_index()
+        matching = [r for r in releases if r['name'] == name]
+        if matching:
+            release = matching[0]
+        else:
+            release = {'name': name, 'commit': name.partition('_')[2], 'deployed_at': name.partition('_')[0]}
+            releases.append(release)
+        release['activated_at'] = time.strftime('%Y-%m-%d-%H-%M-%S')
+        Releases.write_metadata(release)
+        Releases.write_index(releases)
+
+    @staticmethod
+    def get_previous(releases, current):
+        """The release that was active before the current one, if any."""
+        activated = [r for r in releases if r.get('activated_at') and r['name'] != current]
+        if not activated:
+            return None
+        return max(activated, key=lambda r: r['activated_at'])['name']
+
+    @staticmethod
+    def prune(keep=None):
+        """
+        Deletes all but the newest `keep` (default RELEASES_TO_KEEP) releases,
+        never touching the current or previous release.
+
+        Doomed releases are moved aside right away and deleted in the background.
+        """
+        keep = int(RELEASES_TO_KEEP if keep is None else keep)
+        if keep < 0:
+            abort("Can't keep %d releases" % keep)
+        releases, current = Releases.read_index()
+        releases.sort(key=lambda r: r['name'])
+        kept = set(r['name'] for r in releases[-keep:]) if keep else set() # [-0:] is everything
+        kept.add(current)
+        kept.add(Releases.get_previous(releases, current))
+        doomed = [r['name'] for r in releases if r['name'] not in kept]
+        if doomed:
+            print 'Pruning %d old release(s): %s' % (len(doomed), ', '.join(doomed))
+            trash_dir = os.path.join(PROJECT_DIR, 'releases', '.trash-%d' % time.time())
+            with Batch() as batch:
+                batch.add('mkdir -p %s' % trash_dir)
+                for name in doomed:
+                    release_dir = Deploy.get_release_dir(name)
+                    batch.add('[ ! -e %s ] || mv %s %s' % (release_dir, release_dir, trash_dir))
+            Releases.write_index([r for r in releases if r['name'] in kept])
+            run('nohup rm -rf %s > /dev/null 2>&1 &' % trash_dir, pty=False)
+        Releases.prune_virtualenvs([name for name in kept if name])
+
+    @staticmethod
+    def prune_virtualenvs(kept):
+        """
+        Deletes, in the background, the virtualenvs (see Pip.install_requirements)
+        that none of the `kept` releases links to, except the one for the
+        current requirements file.
+        """
+        with hide('running', 'stdout'):
+            output = run('ls -d %s-* 2>/dev/null; echo %s; for release in %s; do readlink %s/$release/env; done; true' % (
+                VIRTUALENV, Releases.CURRENT_MARKER, ' '.join(kept) or '""', os.path.join(PROJECT_DIR, 'releases')))
+        existing, linked = output.split(Releases.CURRENT_MARKER)
+        ve_pattern = re.compile('^%s-[0-9a-f]{12}$' % re.escape(VIRTUALENV))
+        in_use = set(linked.split()) | set([Pip.get_virtualenv_dir()])
+        doomed = [ve_dir for ve_dir in existing.split() if ve_pattern.match(ve_dir) and ve_dir not in in_use]
+        if doomed:
+            print 'Pruning %d unused virtualenv(s): %s' % (len(doomed), ', '.join(doomed))
+            sudo('nohup rm -rf %s > /dev/null 2>&1 &' % ' '.join(doomed), pty=False)
+
+def list_releases(count=10):
+    releases, current = Releases.read_index()
+    previous = Releases.get_previous(releases, current)
+    releases.sort(key=lambda r: r['name'], reverse=True)
+    for release in releases[:int(count)]:
+        marker = {current: 'current', previous: 'previous'}.get(release['name'], '')
+        print '%-8s %s  commit %s  requirements %s  static manifest %s bytes  %s' % (marker,
+            release['deployed_at'], release['commit'][:10], (release.get('requirements_hash') or '?')[:10],
+            release.get('static_manifest_bytes', '?'),
+            'activated ' + release['activated_at'] if release.get('activated_at') else 'never activated')
+
+def prune_releases(keep=None):
+    Releases.prune(keep)
 
 # Two-step Deploy; use this for HA multi-server setup:
 # 1. deploy_prep_new_release
@@ -494,6 +1342,116 @@ def deploy_activate_release(release_name):
     restart_after_deploy()
     Deploy.cleanup_release(release_name)
 
+# Parallel Deploy; same as above, but works on every host in env.hosts at once
+# (DEPLOY_POOL_SIZE at a time). No host is switched over unless all of them
+# prepped successfully.
+# 1. parallel_deploy_prep_new_release
+# 2. parallel_deploy_activate_release:<release_name>
+# or, in one step:
+# 1. parallel_deploy
+
+class _HostAborted(Exception):
+    """What abort() raises within _capture_host_failure, so the message isn't lost."""
+
+def _capture_host_failure(func):
+    """
+    Makes func return (succeeded, result_or_error, timeline_events) instead of
+    aborting, so one bad host doesn't take down the rest of a parallel run.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Parallel hosts run in their own processes, so their timings have
+        # to be passed back along with the result.
+        first_event = len(Timeline.events)
+        try:
+            # Otherwise abort() raises SystemExit(1), and all we'd have is the 1
+            with settings(abort_exception=_HostAborted):
+                outcome = True, func(*args, **kwargs)
+        except (Exception, SystemExit), e:
+            outcome = False, str(e) or e.__class__.__name__
+        events = Timeline.events[first_event:]
+        del Timeline.events[first_event:]
+        return outcome + (events,)
+    return wrapper
+
+def _execute_on_hosts(func, *args, **kwargs):
+    """
+    Runs func on every host in env.hosts (or the `hosts` keyword argument),
+    DEPLOY_POOL_SIZE at a time.
+
+    Prints a per-host summary and returns a {host: result} dict; aborts if any
+    host failed.
+    """
+    description = func.__name__.strip('_').replace('_', ' ')
+    hosts = kwargs.pop('hosts', env.hosts)
+    if not hosts:
+        return {}
+    print "%s on %d host(s), %d at a time" % (description, len(hosts), DEPLOY_POOL_SIZE)
+    task = parallel(pool_size=DEPLOY_POOL_SIZE)(_capture_host_failure(func))
+    outcomes = execute(task, hosts=hosts, *args, **kwargs)
+    failures = {}
+    results = {}
+    print '*'*20
+    for host in hosts:
+        succeeded, result, events = outcomes.get(host, (False, 'no result returned', []))
+        Timeline.events.extend(events)
+        if succeeded:
+            print '[%s] %s: ok' % (host, description)
+            results[host] = result
+        else:
+            print '[%s] %s: FAILED: %s' % (host, description, result)
+            failures[host] = result
+    print '*'*20
+    if failures:
+        abort("%s failed on %d of %d host(s): %s" % (description, len(failures),
+            len(hosts), ', '.join(sorted(failures))))
+    return results
+
+def _prep_new_release():
+    release_name = Deploy.upload_new_release()
+    Deploy.prep_release(release_name)
+    return release_name
+
+def _check_release_exists(release_name):
+    if not exists(Deploy.get_release_dir(release_name)):
+        abort("Release %s is missing" % release_name)
+
+def _activate_release(release_name):
+    Deploy.switch_symlink(release_name)
+    # Rolling restarts drain backends on the nginx hosts, so they're done once, afterwards
+    if len(_django_backends()) == 1:
+        restart_django()
+
+@runs_once
+def parallel_deploy_prep_new_release():
+    local('git push')
+    release_name = Deploy.get_release_name()
+    # The first host runs syncdb/migrate against the (usually shared) database
+    # on its own; by the time the rest prep, the schema is up to date for them.
+    prepped = _execute_on_hosts(_prep_new_release, hosts=env.hosts[:1])
+    prepped.update(_execute_on_hosts(_prep_new_release, hosts=env.hosts[1:]))
+    assert set(prepped.values()) == set([release_name]), prepped
+    print "Prepped new release", release_name, "on", ', '.join(env.hosts)
+    print 'You probably want to parallel_deploy_activate_release:%s' % release_name
+    print '*'*20
+    return release_name
+
+@runs_once
+def parallel_deploy_activate_release(release_name):
+    assert release_name
+    # Check every host has the release before touching any symlinks, so a
+    # missing release can't leave the cluster half switched over.
+    _execute_on_hosts(_check_release_exists, release_name)
+    _execute_on_hosts(_activate_release, release_name)
+    if len(_django_backends()) > 1:
+        rolling_restart_django()
+    Deploy.cleanup_release(release_name)
+
+@runs_once
+def parallel_deploy():
+    release_name = parallel_deploy_prep_new_release()
+    parallel_deploy_activate_release(release_name)
+
 # One-step Deploy; use this for one-server setup or if lazy
 # 1. simple_deploy
 
@@ -504,7 +1462,10 @@ def deploy():
     Deploy.cleanup_release(release_name)
 
 def restart_after_deploy():
-    restart_django()
+    if len(_django_backends()) > 1:
+        _rolling_restart([env.host_string])
+    else:
+        restart_django()
 
 def simple_deploy():
     local('git push')
@@ -516,7 +1477,7 @@ def simple_deploy():
 # 
 
 def reload_nginx():
-    sudo('initctl reload nginx')
+    sudo('/etc/init.d/nginx reload')
 
 def reload_django():
     sudo('apache2ctl graceful')
@@ -533,11 +1494,107 @@ def restart_nginx():
 def restart_django():
     sudo('apache2ctl graceful || apache2ctl start')
 
+def _drain_backends(down=()):
+    """Takes the `down` backends out of this nginx's rotation, or puts them all back."""
+    _upload_nginx_site(down=down)
+    reload_nginx()
+
+def _restart_backend(port):
+    """Restarts this host's backend on `port` and waits up to a minute for it to answer."""
+    # The daemon processes exit gracefully on SIGINT and Apache starts (and preloads) new ones
+    sudo("pkill -INT -f '^\\(wsgi:%s-%d\\)' || true" % (PROJECT_NAME, port))
+    run("for i in $(seq 60); do [ \"$(curl -s -o /dev/null -w '%%{http_code}' -H 'Host: %s' http://127.0.0.1:%d/)\" = 200 ] && exit 0; "
+        "sleep 1; done; exit 1" % (env.stage['hostname'], port))
+
+def _rolling_restart(django_hosts):
+    """
+    Restarts the backends on `django_hosts` one port at a time, each drained
+    from every nginx in NGINX_HOSTS until it answers again. A 127.0.0.1
+    backend is the one on each of the hosts.
+    """
+    nginx_hosts = NGINX_HOSTS or env.hosts
+    for host, port in _django_backends():
+        if host in ('127.0.0.1', 'localhost'):
+            hosts = django_hosts
+        else:
+            hosts = [h for h in django_hosts if h.split('@')[-1].split(':')[0] == host]
+        if not hosts:
+            continue
+        execute(_drain_backends, [(host, port)], hosts=nginx_hosts)
+        try:
+            execute(_restart_backend, port, hosts=hosts)
+        finally:
+            # Even if it didn't come back; nginx's own failure handling beats a backend left out
+            execute(_drain_backends, hosts=nginx_hosts)
+
+@runs_once
+def rolling_restart_django():
+    """
+    Restarts the Django backends on every host one at a time, each out of
+    nginx's rotation until it answers again, so there's always one serving.
+    A backend that doesn't come back aborts the restart.
+    """
+    _rolling_restart(env.hosts)
+
 def restart_database():
     if PG_VERSION < (9, 0):
         sudo('/etc/init.d/postgresql-8.4 restart || /etc/init.d/postgresql-8.4 start')
     else:
         sudo('/etc/init.d/postgresql restart || /etc/init.d/postgresql start')
 
+def restart_pooler():
+    sudo('/etc/init.d/pgbouncer restart || /etc/init.d/pgbouncer start')
+
+def restart_memcached():
+    sudo('/etc/init.d/memcached restart')
+
 def restart_smtp():
     sudo('/etc/init.d/postfix restart')
+
+#
+# Reporting
+#
+
+@runs_once
+def deploy_report(count=10):
+    """Summarizes the slowest steps of the last `count` deploys."""
+    filenames = sorted(glob.glob(os.path.join(DEPLOY_TIMELINE_DIR, '*.json')))[-int(count):]
+    if not filenames:
+        abort("No deploy timelines in %s" % DEPLOY_TIMELINE_DIR)
+    steps = {}
+    print 'Deploys:'
+    for filename in filenames:
+        timeline = json.load(open(filename))
+        print '  %8.1fs  %s%s' % (timeline['duration'], os.path.basename(filename),
+            ' (FAILED)' if timeline['failed'] else '')
+        for event in timeline['events']:
+            # Release names change every deploy; blank them out so steps line up
+            command = re.sub(r'\d{4}(-\d\d){5}_[0-9a-f]{40}', '<release>', event['command'] or '')
+            step = steps.setdefault((event['kind'], command), {'durations': [], 'bytes': 0})
+            step['durations'].append(event['duration'])
+            step['bytes'] += event.get('bytes') or 0
+    print
+    print 'Slowest steps (total seconds across %d deploys, calls, mean, max, bytes):' % len(filenames)
+    ranked = sorted(steps.items(), key=lambda item: -sum(item[1]['durations']))
+    for (kind, command), step in ranked[:20]:
+        durations = step['durations']
+        print '  %8.1f %5d %7.2f %7.2f %10d  %s: %s' % (sum(durations), len(durations),
+            sum(durations) / len(durations), max(durations), step['bytes'], kind,
+            command.replace('\n', '; ')[:100])
+
+#
+# Timing; keep this at the bottom so it wraps every task defined above
+#
+
+# Helpers that aren't tasks; the run/sudo/put calls they make are timed anyway
+_UNTIMED = ['upload_template', 'home_dir', 'run_with_safe_error', 'make_symlink_atomically']
+
+for _name, _value in globals().items():
+    if (isinstance(_value, types.FunctionType) and _value.__module__ == __name__
+            and not _name.startswith('_') and _name not in _UNTIMED):
+        globals()[_name] = Timeline.timed('task', _value)
+
+# The deploy's main steps, within its tasks
+for _box, _name in [(Deploy, 'upload_new_release'), (Pip, 'install_requirements'), (Deploy, 'prep_release'),
+        (Deploy, 'switch_symlink')]:
+    setattr(_box, _name, staticmethod(Timeline.timed('step', getattr(_box, _name), '%s.%s' % (_box.__name__, _name))))
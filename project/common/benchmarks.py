@@ -0,0 +1,64 @@
+"""Helpers for the bench_* management commands."""
+
+import datetime, time
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+def make_model(name, base, **attrs):
+    """Makes a concrete model class, in the common app, for a benchmark to use."""
+    class Meta:
+        app_label = 'common'
+    attrs.update({'__module__': __name__, 'Meta': Meta})
+    return type(name, (base,), attrs)
+
+class scratch_table(object):
+    """Creates the model's table (and indexes) on entry and drops it on exit."""
+    def __init__(self, model):
+        self.model = model
+
+    def __enter__(self):
+        statements, _ = connection.creation.sql_create_model(self.model, no_style(), set())
+        statements += connection.creation.sql_indexes_for_model(self.model, no_style())
+        cursor = connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        transaction.commit_unless_managed()
+        return self.model
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        transaction.rollback_unless_managed()
+        connection.cursor().execute('DROP TABLE %s' % connection.ops.quote_name(self.model._meta.db_table))
+        transaction.commit_unless_managed()
+
+def insert_rows(model, ids, batch_size=1000):
+    """Inserts a BaseModel row for each of `ids`, skipping the ORM; returns the seconds each batch took."""
+    fields = model._meta.local_fields
+    now = datetime.datetime.now()
+    values = dict(created_at=now, updated_at=now, notes='')
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(f.column) for f in fields), ', '.join(['%s'] * len(fields)))
+    cursor = connection.cursor()
+    batch_seconds = []
+    for start in xrange(0, len(ids), batch_size):
+        rows = [[f.get_db_prep_save(id if f.name == 'id' else values[f.name], connection=connection)
+            for f in fields] for id in ids[start:start + batch_size]]
+        seconds, _ = timed(cursor.executemany, sql, rows)
+        transaction.commit_unless_managed()
+        batch_seconds.append(seconds)
+    return batch_seconds
+
+def timed(func, *args, **kwargs):
+    """Returns (seconds taken, result) of calling func."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def per_row_us(seconds, rows):
+    return seconds * 1e6 / max(rows, 1)
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list, e.g. percentile(latencies, 0.99)."""
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
@@ -0,0 +1,73 @@
+from django.core.cache.backends.memcached import PyLibMCCache
+
+class BinaryPyLibMCCache(PyLibMCCache):
+    """
+    Django's pylibmc backend, but speaking memcached's binary protocol, and
+    spreading keys over the nodes in LOCATION by consistent (ketama) hashing,
+    so adding or removing a node only moves that node's share of the keys.
+
+    Like python-memcached, and unlike pylibmc, a node that's down or missing
+    makes reads miss and writes do nothing, rather than raise: get() returns
+    the default, add() False, and incr() and decr() raise ValueError as for a
+    missing key. Callers like common.views.cached_view count on that.
+
+    OPTIONS are pylibmc behaviors, and override DEFAULT_BEHAVIORS.
+    """
+    DEFAULT_BEHAVIORS = {
+        'ketama': True,
+        'tcp_nodelay': True,
+        'connect_timeout': 500, # ms; a dead node shouldn't hold up a request for long
+    }
+
+    @property
+    def _cache(self):
+        # One client per thread, as in PyLibMCCache; binary can only be set when it's created
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._lib.Client(self._servers, binary=True)
+            client.behaviors = dict(self.DEFAULT_BEHAVIORS, **(self._options or {}))
+            self._local.client = client
+        return client
+
+    def _call(self, method, failed, *args, **kwargs):
+        """Returns getattr(PyLibMCCache, method)(...), or `failed` if memcached can't be reached."""
+        try:
+            return getattr(super(BinaryPyLibMCCache, self), method)(*args, **kwargs)
+        except self._lib.Error:
+            return failed
+
+    def add(self, key, value, timeout=0, version=None):
+        return self._call('add', False, key, value, timeout, version)
+
+    def get(self, key, default=None, version=None):
+        return self._call('get', default, key, default, version)
+
+    def set(self, key, value, timeout=0, version=None):
+        self._call('set', None, key, value, timeout, version)
+
+    def delete(self, key, version=None):
+        self._call('delete', None, key, version)
+
+    def get_many(self, keys, version=None):
+        return self._call('get_many', {}, keys, version)
+
+    def set_many(self, data, timeout=0, version=None):
+        self._call('set_many', None, data, timeout, version)
+
+    def delete_many(self, keys, version=None):
+        self._call('delete_many', None, keys, version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self._call('incr', None, key, delta, version)
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        value = self._call('decr', None, key, delta, version)
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
+        return value
+
+    def clear(self):
+        self._call('clear', None)
@@ -1,22 +1,62 @@
 from django.db import models
 
-import uuid
+import binascii, os, sys, threading, time, uuid
+
+_ordered_lock = threading.Lock()
+_ordered_state = [0, 0] # Last millisecond timestamp and sequence number handed out
+
+def ordered_uuids(count):
+    """
+    Returns `count` time-ordered UUIDs as hex strings, in increasing order
+    (also across calls in this process). Uses the UUIDv7 layout: a 48-bit
+    millisecond timestamp, a 12-bit sequence number and 62 random bits.
+    """
+    random_bits = os.urandom(8 * count)
+    hexes = []
+    with _ordered_lock:
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = _ordered_state
+        if ms <= last_ms:
+            ms, seq = last_ms, last_seq + 1
+        else:
+            seq = 0
+        for i in xrange(count):
+            if seq > 0xfff:
+                ms, seq = ms + 1, 0
+            rand = int(binascii.hexlify(random_bits[8 * i:8 * i + 8]), 16) & 0x3fffffffffffffff
+            hexes.append('%032x' % ((ms << 80) | (0x7 << 76) | (seq << 64) | (0x2 << 62) | rand))
+            seq += 1
+        _ordered_state[:] = [ms, seq - 1]
+    return hexes
  
 class UUIDField(models.CharField):
     """
-    A field which stores a UUID value in hex format. This may also have
-    the Boolean attribute 'auto' which will set the value on initial save to a
-    new UUID value (calculated using the UUID1 method). Note that while all
-    UUIDs are expected to be unique we enforce this with a DB constraint.
+    A field which stores a UUID value. In Python the value is a 32 character
+    hex string; in the database it is a native uuid on Postgres and 16 bytes
+    of binary on sqlite and MySQL, half the size of the hex text. This may
+    also have the Boolean attribute 'auto' which will set the value on initial
+    save to a new UUID value (calculated using the UUID4 method, or, with
+    'ordered', ordered_uuids). Note that while all UUIDs are expected to be
+    unique we enforce this with a DB constraint.
+
+    Random UUIDs scatter inserts all over the primary key index; ordered ones
+    keep them on its right-hand edge. A model can also ask for ordered ids by
+    setting an `ordered_ids` class attribute (see common.models.BaseModel).
+
+    Foreign key attributes (e.g. obj.parent_id) hold the raw database value,
+    which is binary on sqlite and MySQL; compare related objects' ids instead.
+    Switching an existing sqlite/MySQL table from the old hex text storage
+    needs a data migration.
     """
     # Modified from http://www.davidcramer.net/code/420/improved-uuidfield-in-django.html
     __metaclass__ = models.SubfieldBase
  
-    def __init__(self, auto=False, *args, **kwargs):
+    def __init__(self, auto=False, ordered=False, *args, **kwargs):
         if kwargs.get('primary_key', False):
             assert auto, "Must pass auto=True when using UUIDField as primary key."
         self.auto = auto
-        # Set this as a fixed value, we store UUIDs in text.
+        self.ordered = ordered
+        # Set this as a fixed value, the length of the hex string in Python.
         kwargs['max_length'] = 32
         if auto:
             # Do not let the user edit UUIDs if they are auto-assigned.
@@ -24,25 +64,58 @@ class UUIDField(models.CharField):
             kwargs['unique'] = True
         super(UUIDField, self).__init__(*args, **kwargs)
  
-    def db_type(self):
-        return 'uuid'
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'uuid'
+        if connection.vendor == 'sqlite':
+            return 'blob'
+        if connection.vendor == 'mysql':
+            return 'binary(16)'
+        return 'char(32)'
  
     def pre_save(self, model_instance, add):
         """Ensures that we auto-set values if required. See CharField.pre_save."""
         value = getattr(model_instance, self.attname, None)
         if add and (not value) and self.auto:
             # Assign a new value for this attribute if required.
-            value = uuid.uuid4().hex
+            value = self.new_values(model_instance, 1)[0]
             setattr(model_instance, self.attname, value)
         return value
 
+    def new_values(self, model_instance, count):
+        if self.ordered or getattr(model_instance, 'ordered_ids', False):
+            return ordered_uuids(count)
+        return [uuid.uuid4().hex for i in xrange(count)]
+
+    def assign_values(self, objs):
+        """Gives the objects in `objs` that don't have a value yet new values, all at once."""
+        objs = [obj for obj in objs if not getattr(obj, self.attname, None)]
+        if objs:
+            for obj, value in zip(objs, self.new_values(objs[0], len(objs))):
+                setattr(obj, self.attname, value)
+
     def to_python(self, value):
+        # Called on every assignment, so check for the usual case first
+        if isinstance(value, basestring) and len(value) == 32:
+            return value
         if not value:
             return None
-        if len(value) != 32:
-            value = value.replace('-', '')
+        if isinstance(value, uuid.UUID):
+            return value.hex
+        if len(value) == 16: # Binary, from the database
+            return binascii.hexlify(value)
+        value = value.replace('-', '')
         assert len(value) == 32
         return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        # By keyword: on Django 1.3, SubfieldBase's shim passes connection that way too
+        if value is None or self.db_type(connection=connection) in ('uuid', 'char(32)'):
+            return value
+        # The DB-API module is a global of the backend's base module, not an attribute of the connection
+        return sys.modules[connection.__module__].Database.Binary(binascii.unhexlify(value))
  
 try:
     from south.modelsinspector import add_introspection_rules
@@ -55,6 +128,7 @@ else:
             [],         # Positional arguments (not used)
             {           # Keyword argument
                 "auto": ["auto", {"default": "False"}],
+                "ordered": ["ordered", {"default": "False"}],
             },
         ),
     ], ["^common\.fields\.UUIDField"])
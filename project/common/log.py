@@ -1,4 +1,5 @@
-import os, logging, logging.handlers, time
+import atexit, os, logging, logging.handlers, Queue, threading, time
+from functools import wraps
 
 from django.conf import settings
 
@@ -29,21 +30,122 @@ _mkdir(settings.LOG_DIRECTORY)
 # files have g+w.)
 filename = settings.LOG_DIRECTORY + '/django_%s.log' % os.getuid()
 
+class LazyMessage(object):
+    """Joins a log call's arguments only when the record actually gets formatted."""
+    def __init__(self, args):
+        self.args = args
+
+    def __unicode__(self):
+        return u', '.join(unicode(a) for a in self.args)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
 def convert_log_args(f):
     """Makes logger functions act right."""
-    from functools import wraps
     @wraps(f)
     def new_f(*args):
-        return f(', '.join(unicode(a) for a in args))
+        return f(LazyMessage(args))
     return new_f
 
-logger = logging.getLogger('default')
-handler = logging.handlers.RotatingFileHandler(filename, maxBytes=10*1024*1024, backupCount=10)
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue for a QueueListener, instead of writing them on
+    the calling thread. If the queue is full, records are dropped rather than
+    blocking the request, and counted in a warning once there's room again.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format the message and traceback now, on the calling thread: the
+        # arguments may be lazy querysets or models that need its database
+        # connection, or change before the listener gets to them.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({'name': record.name,
+                    'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '%d log records dropped; the log queue was full' % self.dropped}))
+                self.dropped = 0
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(threading.Thread):
+    """
+    Background thread that formats queued records and writes them to `handler`
+    in batches, one write and flush per batch.
+    """
+    MAX_BATCH = 100
+
+    def __init__(self, queue, handler, formatter):
+        threading.Thread.__init__(self, name='common.log writer')
+        self.daemon = True
+        self.queue = queue
+        self.handler = handler
+        self.formatter = formatter
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.MAX_BATCH:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            lines = []
+            for record in records:
+                if record is None: # See stop()
+                    stopping = True
+                    continue
+                try:
+                    line = self.formatter.format(record)
+                except Exception:
+                    self.handler.handleError(record)
+                    continue
+                if isinstance(line, unicode):
+                    line = line.encode('utf-8')
+                lines.append(line)
+            if lines:
+                # The handler only sees one record per batch, whose message is the formatted lines
+                self.handler.handle(logging.makeLogRecord({'msg': '\n'.join(lines)}))
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(5)
+
+# Rotation is left to logrotate (see server/logrotate), since Apache runs many
+# processes writing to the same file. WatchedFileHandler reopens the file once
+# logrotate has moved it.
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+handler = logging.handlers.WatchedFileHandler(filename)
+
+logger = logging.getLogger('default')
+if settings.LOG_QUEUE:
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_queue = Queue.Queue(10000)
+    listener = QueueListener(log_queue, handler, formatter)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
+else:
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
-logger.setLevel(1) # 0 seems to skip DEBUG messages, contrary to the docs
+logger.setLevel(settings.LOG_LEVEL) # 0 seems to skip DEBUG messages, contrary to the docs
 
 debug =     convert_log_args(logger.debug)
 info =      convert_log_args(logger.info)
@@ -51,4 +153,3 @@ warning =   convert_log_args(logger.warning)
 error =     convert_log_args(logger.error)
 critical =  convert_log_args(logger.critical)
 exception = convert_log_args(logger.exception)
-
@@ -0,0 +1,46 @@
+import time
+from optparse import make_option
+
+from django.core.cache import get_cache
+from django.core.management.base import NoArgsCommand
+
+from common.benchmarks import timed, per_row_us
+
+BACKENDS = [
+    ('python-memcached', 'django.core.cache.backends.memcached.MemcachedCache'),
+    ('pylibmc', 'django.core.cache.backends.memcached.PyLibMCCache'),
+    ('pylibmc binary', 'common.cache.BinaryPyLibMCCache'),
+]
+
+class Command(NoArgsCommand):
+    help = ("Compares set/get/get_many throughput of the memcached cache backends against a "
+            "running memcached, e.g. a local one. Backends whose client library isn't installed are skipped.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--location', dest='location', default='127.0.0.1:11211',
+            help="memcached to use; ';'-separated for several (default 127.0.0.1:11211)"),
+        make_option('--keys', dest='keys', type='int', default=10000, help="Keys to set and get (default 10000)"),
+        make_option('--size', dest='size', type='int', default=200, help="Bytes per value (default 200)"),
+        make_option('--batch', dest='batch', type='int', default=20, help="Keys per get_many (default 20)"),
+    )
+
+    def handle_noargs(self, **options):
+        count, batch = options['keys'], options['batch']
+        value = 'x' * options['size']
+        self.stdout.write("%d keys of %d bytes on %s\n" % (count, options['size'], options['location']))
+        for name, backend in BACKENDS:
+            try:
+                cache = get_cache(backend, LOCATION=options['location'])
+                cache.get('bench_memcached') # Imports the client library and connects
+            except ImportError, e:
+                self.stdout.write("  %-16s skipped: %s\n" % (name, e))
+                continue
+            # Keys unique to this run, so nothing is left over from an earlier one
+            keys = ['bench_memcached:%s:%d:%d' % (name.replace(' ', '_'), time.time(), i) for i in xrange(count)]
+            set_seconds, _ = timed(lambda: [cache.set(key, value) for key in keys])
+            get_seconds, found = timed(lambda: [cache.get(key) for key in keys])
+            many_seconds, _ = timed(lambda: [cache.get_many(keys[i:i + batch]) for i in xrange(0, count, batch)])
+            missing = len([v for v in found if v != value])
+            self.stdout.write("  %-16s set %7.0f/s  get %7.0f/s  get_many %7.0f keys/s  (%.1f us/get)%s\n" % (
+                name, count / set_seconds, count / get_seconds, count / many_seconds,
+                per_row_us(get_seconds, count), ", %d MISSING" % missing if missing else ''))
+            cache.delete_many(keys)
@@ -0,0 +1,112 @@
+import gc, random, time
+from optparse import make_option
+from StringIO import StringIO
+from urlparse import urlsplit
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.client import ClientHandler
+
+from common.benchmarks import percentile
+from common.tests import RequestFactory
+
+DEFAULT_URLS = ['/:4', '/admin/:1', '/robots.txt:1']
+
+class Command(NoArgsCommand):
+    help = ("Sends a weighted mix of GET requests through the full middleware stack and reports "
+            "requests/s, latency percentiles, queries and gc-tracked objects per request. "
+            "Runs against a fresh test database; use sqlite (see example_localsettings.py) "
+            "so it's in memory.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', dest='requests', type='int', default=2000,
+            help="Timed requests to send (default 2000)"),
+        make_option('--warmup', dest='warmup', type='int', default=100,
+            help="Untimed requests to send first (default 100)"),
+        make_option('--url', dest='urls', action='append', default=None,
+            help="PATH[?QUERY][:WEIGHT] to request; repeat for a mix (default %s)" % ' '.join(DEFAULT_URLS)),
+    )
+
+    def handle_noargs(self, **options):
+        mix = []
+        for spec in options['urls'] or DEFAULT_URLS:
+            url, sep, weight = spec.rpartition(':')
+            if not sep or not weight.isdigit():
+                url, weight = spec, 1
+            mix += [url] * int(weight)
+        if not mix:
+            raise CommandError("No requests to send")
+        random.Random(0).shuffle(mix)
+        urls = sorted(set(mix))
+
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            # One handler for the whole run, so middleware is loaded once, as in a server process
+            handler = ClientHandler(enforce_csrf_checks=False)
+            factory = RequestFactory()
+            def send(url):
+                parts = urlsplit(url)
+                response = handler(factory.get_environ(PATH_INFO=parts.path, QUERY_STRING=parts.query,
+                    REQUEST_METHOD='GET', **{'wsgi.input': StringIO()}))
+                for chunk in response: # Streamed responses do their work here
+                    pass
+                response.close()
+                return response.status_code
+
+            statuses = dict((url, set()) for url in urls)
+            for i in xrange(options['warmup']):
+                send(mix[i % len(mix)])
+
+            latencies = dict((url, []) for url in urls)
+            start = time.time()
+            for i in xrange(options['requests']):
+                url = mix[i % len(mix)]
+                request_start = time.time()
+                statuses[url].add(send(url))
+                latencies[url].append(time.time() - request_start)
+            elapsed = time.time() - start
+
+            # Counted in a separate pass, since the debug cursor and gc bookkeeping skew timings.
+            # request_started resets connection.queries.
+            queries = dict((url, 0) for url in urls)
+            connection.use_debug_cursor = True
+            try:
+                for url in urls:
+                    send(url)
+                    queries[url] = len(connection.queries)
+            finally:
+                connection.use_debug_cursor = None
+
+            # With automatic collection off, the generation 0 count is the net number of
+            # container objects each request allocates and leaves for the collector.
+            objects = dict((url, []) for url in urls)
+            count = max(min(options['requests'], 200 * len(urls)), 1)
+            gc.collect()
+            tracked_before = len(gc.get_objects())
+            gc.disable()
+            try:
+                for i in xrange(count):
+                    url = mix[i % len(mix)]
+                    before = gc.get_count()[0]
+                    send(url)
+                    objects[url].append(gc.get_count()[0] - before)
+            finally:
+                gc.enable()
+            garbage = gc.collect()
+            retained = len(gc.get_objects()) - tracked_before
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        all_latencies = sorted(sum(latencies.values(), []))
+        self.stdout.write("%d requests in %.2fs on %s: %.1f requests/s, p50 %.2fms, p90 %.2fms, p99 %.2fms\n" % (
+            options['requests'], elapsed, connection.vendor, options['requests'] / max(elapsed, 1e-9),
+            percentile(all_latencies, 0.5) * 1000, percentile(all_latencies, 0.9) * 1000,
+            percentile(all_latencies, 0.99) * 1000))
+        self.stdout.write("gc: %.1f unreachable and %.1f retained objects per request\n" % (
+            garbage / float(count), retained / float(count)))
+        for url in urls:
+            times = sorted(latencies[url])
+            self.stdout.write("  %-30s %-9s n=%-6d p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  "
+                "%3d queries  %6.0f objects\n" % (url, '/'.join(str(s) for s in sorted(statuses[url])),
+                len(times), percentile(times, 0.5) * 1000, percentile(times, 0.9) * 1000,
+                percentile(times, 0.99) * 1000, queries[url],
+                sum(objects[url]) / float(max(len(objects[url]), 1))))
@@ -0,0 +1,44 @@
+import uuid
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from common.benchmarks import make_model, scratch_table, insert_rows, timed, per_row_us
+from common.fields import ordered_uuids
+from common.models import BaseModel
+
+class Command(NoArgsCommand):
+    help = ("Compares inserting BaseModel rows with random (uuid4) and time-ordered primary keys. "
+            "Creates and drops its own tables; point it at sqlite (see example_localsettings.py) "
+            "or a scratch Postgres database.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rows', dest='rows', type='int', default=100000, help="Rows to insert (default 100000)"),
+    )
+
+    def handle_noargs(self, **options):
+        rows = options['rows']
+        self.stdout.write("%d rows on %s\n" % (rows, connection.vendor))
+        for name, generate, ordered in [
+                ('uuid4', lambda: [uuid.uuid4().hex for i in xrange(rows)], False),
+                ('ordered', lambda: ordered_uuids(rows), True)]:
+            model = make_model('%sInsertBenchmark' % name.capitalize(), BaseModel, ordered_ids=ordered)
+            generate_seconds, ids = timed(generate)
+            with scratch_table(model):
+                batch_seconds = insert_rows(model, ids)
+                index_size = self.get_pk_index_size(model)
+            # Random keys get slower as the index outgrows the cache, so compare the ends
+            tenth = max(len(batch_seconds) / 10, 1)
+            self.stdout.write("  %-8s generate %6.2f us/row, insert %6.1f rows/s overall, "
+                "first 10%% %6.1f rows/s, last 10%% %6.1f rows/s%s\n" % (name,
+                per_row_us(generate_seconds, rows), rows / sum(batch_seconds),
+                rows * tenth / float(len(batch_seconds)) / sum(batch_seconds[:tenth]),
+                rows * tenth / float(len(batch_seconds)) / sum(batch_seconds[-tenth:]),
+                ", pk index %d kB" % (index_size / 1024) if index_size else ''))
+
+    def get_pk_index_size(self, model):
+        if connection.vendor != 'postgresql':
+            return None
+        cursor = connection.cursor()
+        cursor.execute("SELECT pg_relation_size(%s)", ['%s_pkey' % model._meta.db_table])
+        return cursor.fetchone()[0]
@@ -0,0 +1,42 @@
+import uuid
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from common.benchmarks import make_model, scratch_table, insert_rows, timed, per_row_us
+from common.models import BaseModel
+
+class Command(NoArgsCommand):
+    help = ("Loads BaseModel rows and reports the per-row cost of UUIDField. Creates and drops its own "
+            "table; point it at sqlite (see example_localsettings.py) or a scratch Postgres database.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rows', dest='rows', type='int', default=100000, help="Rows to load (default 100000)"),
+    )
+
+    def handle_noargs(self, **options):
+        rows = options['rows']
+        model = make_model('UUIDLoadBenchmark', BaseModel)
+        with scratch_table(model):
+            insert_rows(model, [uuid.uuid4().hex for i in xrange(rows)])
+            table = connection.ops.quote_name(model._meta.db_table)
+
+            def fetch_raw():
+                cursor = connection.cursor()
+                cursor.execute('SELECT id, created_at, updated_at, notes FROM %s' % table)
+                return cursor.fetchall()
+            raw_seconds, raw_rows = timed(fetch_raw)
+            orm_seconds, _ = timed(lambda: list(model.objects.all().iterator()))
+
+            field = model._meta.get_field('id')
+            raw_ids = [row[0] for row in raw_rows]
+            hex_ids = [field.to_python(raw_id) for raw_id in raw_ids]
+            convert_seconds, _ = timed(lambda: [field.to_python(raw_id) for raw_id in raw_ids])
+            fast_seconds, _ = timed(lambda: [field.to_python(hex_id) for hex_id in hex_ids])
+
+        self.stdout.write("%d rows on %s, id column type %s\n" % (rows, connection.vendor, field.db_type(connection=connection)))
+        self.stdout.write("  raw cursor fetch:            %7.2f us/row\n" % per_row_us(raw_seconds, rows))
+        self.stdout.write("  ORM load:                    %7.2f us/row\n" % per_row_us(orm_seconds, rows))
+        self.stdout.write("  to_python from the database: %7.2f us/row\n" % per_row_us(convert_seconds, rows))
+        self.stdout.write("  to_python on hex (fast path):%7.2f us/row\n" % per_row_us(fast_seconds, rows))
+
@@ -0,0 +1,83 @@
+import hashlib, os, shutil
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.management.base import NoArgsCommand
+from django.utils import simplejson
+
+from root_dir import root_dir
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            md5.update(chunk)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+def release_path(release_root, path):
+    """Where `path`, a path in this release, lives in the release at release_root."""
+    return os.path.join(release_root, os.path.relpath(path, root_dir('..')))
+
+def load_manifest(filename):
+    if not os.path.exists(filename):
+        return {}
+    f = open(filename)
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+class Command(NoArgsCommand):
+    help = ("Collects static files into STATIC_ROOT like collectstatic, but hardlinks files "
+            "that are unchanged since the previous release instead of copying them.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--previous', dest='previous', default=None,
+            help="Root directory of the previous release, e.g. /project/<name>/current"),
+    )
+
+    def handle_noargs(self, **options):
+        previous = options['previous']
+        previous_manifest = {}
+        if previous:
+            previous_static_root = release_path(previous, settings.STATIC_ROOT)
+            previous_manifest = load_manifest(release_path(previous, settings.STATIC_MANIFEST))
+
+        manifest = {}
+        linked = copied = 0
+        for finder in finders.get_finders():
+            for path, storage in finder.list(['CVS', '.*', '*~']):
+                if getattr(storage, 'prefix', None):
+                    prefixed_path = os.path.join(storage.prefix, path)
+                else:
+                    prefixed_path = path
+                if prefixed_path in manifest:
+                    continue # As with collectstatic, the first file found wins
+                source = storage.path(path)
+                digest = file_md5(source)
+                manifest[prefixed_path] = digest
+
+                destination = os.path.join(settings.STATIC_ROOT, prefixed_path)
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                if os.path.exists(destination):
+                    os.remove(destination)
+                if previous_manifest.get(prefixed_path) == digest:
+                    try:
+                        os.link(os.path.join(previous_static_root, prefixed_path), destination)
+                        linked += 1
+                        continue
+                    except OSError: # Gone, or on another filesystem
+                        pass
+                shutil.copy2(source, destination)
+                copied += 1
+
+        f = open(settings.STATIC_MANIFEST, 'w')
+        try:
+            simplejson.dump(manifest, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        self.stdout.write("%d static files copied, %d hardlinked from the previous release.\n" % (copied, linked))
@@ -0,0 +1,105 @@
+import hashlib, os, time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand
+from django.db import models, transaction, DatabaseError
+
+from common.models import DeployState
+
+SCHEMA_HASH_KEY = 'schema_hash'
+
+def source_file(module):
+    filename = module.__file__
+    if filename.endswith('.pyc') or filename.endswith('.pyo'):
+        filename = filename[:-1]
+    return filename
+
+def files_under(dirname, prefix=''):
+    if not os.path.isdir(dirname):
+        return []
+    return sorted(os.path.join(dirname, f) for f in os.listdir(dirname)
+        if f.startswith(prefix) and not f.endswith('.pyc'))
+
+def app_schema_files(label, models_file):
+    """
+    Returns (name, filename) pairs for an app's models, South migrations and
+    initial_data fixtures. Names are relative to the app, since the app's
+    absolute path changes with every release (and virtualenv).
+    """
+    app_dir = os.path.dirname(models_file)
+    if os.path.basename(models_file) == '__init__.py': # models package
+        filenames = files_under(app_dir)
+        app_dir = os.path.dirname(app_dir)
+    else:
+        filenames = [models_file]
+    filenames.extend(files_under(os.path.join(app_dir, 'migrations')))
+    filenames.extend(files_under(os.path.join(app_dir, 'fixtures'), 'initial_data.'))
+    return [(os.path.join(label, os.path.relpath(filename, app_dir)), filename) for filename in filenames]
+
+def hash_files(named_files, seed=''):
+    md5 = hashlib.md5(seed)
+    for name, filename in named_files:
+        md5.update(name)
+        md5.update(open(filename, 'rb').read())
+    return md5.hexdigest()
+
+def get_schema_hash():
+    """
+    Hash of everything syncdb, migrate and loaddata initial_data depend on:
+    the installed apps, their models, South migrations and initial_data fixtures.
+    """
+    named_files = []
+    for app in models.get_apps():
+        named_files.extend(app_schema_files(app.__name__, source_file(app)))
+    for i, fixture_dir in enumerate(getattr(settings, 'FIXTURE_DIRS', ())):
+        named_files.extend((os.path.join('FIXTURE_DIRS', str(i), os.path.basename(filename)), filename)
+            for filename in files_under(fixture_dir, 'initial_data.'))
+    return hash_files(named_files, '\n'.join(settings.INSTALLED_APPS))
+
+def get_recorded_schema_hash():
+    try:
+        return DeployState.objects.get(key=SCHEMA_HASH_KEY).value
+    except DeployState.DoesNotExist:
+        return None
+    except DatabaseError: # First deploy; syncdb hasn't made the table yet
+        transaction.rollback_unless_managed()
+        return None
+
+def record_schema_hash(schema_hash):
+    state, created = DeployState.objects.get_or_create(key=SCHEMA_HASH_KEY, defaults={'value': schema_hash})
+    if not created:
+        state.value = schema_hash
+        state.save()
+
+class Command(NoArgsCommand):
+    help = ("Prepares a release in one process: syncdb, migrate, loaddata initial_data and "
+            "collectstatic_incremental. The database steps are skipped when no models, migrations "
+            "or fixtures changed since they last ran against this database.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--previous', dest='previous', default=None,
+            help="Root directory of the previous release, passed on to collectstatic_incremental"),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help="Run the database steps even if nothing changed"),
+    )
+
+    def timed_step(self, name, func, *args, **kwargs):
+        """Calls func, and reports how long it took for the fabfile's deploy timeline (see its Timeline)."""
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.stdout.write("TIMELINE_STEP %.3f %.3f prep_release: %s\n" % (start, time.time(), name))
+        return result
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        schema_hash = self.timed_step('schema hash', get_schema_hash)
+        if options['force'] or get_recorded_schema_hash() != schema_hash:
+            self.timed_step('syncdb', call_command, 'syncdb', interactive=False, verbosity=verbosity)
+            self.timed_step('migrate', call_command, 'migrate', interactive=False, verbosity=verbosity)
+            self.timed_step('loaddata', call_command, 'loaddata', 'initial_data', verbosity=verbosity)
+            record_schema_hash(schema_hash)
+        else:
+            self.stdout.write("Models, migrations and fixtures unchanged; skipping syncdb, migrate and loaddata.\n")
+        self.timed_step('collectstatic_incremental', call_command, 'collectstatic_incremental',
+            previous=options['previous'], verbosity=verbosity)
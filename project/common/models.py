@@ -2,11 +2,29 @@ from django.db import models
 
 from common.fields import UUIDField
 
+class BaseModelManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        """Assigns all the new ids in one go before the usual bulk_create (Django 1.4+)."""
+        self.model._meta.pk.assign_values(objs)
+        return super(BaseModelManager, self).bulk_create(objs, *args, **kwargs)
+
 class BaseModel(models.Model):
     id = UUIDField(primary_key=True, auto=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     notes = models.TextField(blank=True)
 
+    objects = BaseModelManager()
+
+    # Set to True in subclasses with big, insert-heavy tables: time-ordered ids
+    # keep inserts on the right-hand edge of the primary key index.
+    ordered_ids = False
+
     class Meta:
         abstract = True
+
+class DeployState(models.Model):
+    """Facts the deploy process records in the database, e.g. what migrations were last applied."""
+    key = models.CharField(max_length=100, primary_key=True)
+    value = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
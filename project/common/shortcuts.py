@@ -39,3 +39,76 @@ def date_breakdown(min_date, max_date, freq):
             range_start = datetime.date(range_end.year, range_end.month, 1)
         yield range_start, range_end
 
+
+def time_buckets(queryset, date_field, freq, min_date=None, max_date=None, sum_field=None):
+    """
+    Totals `queryset` over the date_breakdown(min_date, max_date, freq) ranges
+    in one query, rather than one query per range.
+
+    Returns a list of (start_date, end_date, value) triples, newest first like
+    date_breakdown, where value is the number of rows whose `date_field` falls
+    in the range, or the sum of `sum_field` over them. Empty ranges get 0.
+    `date_field` must be a DateField or DateTimeField on the queryset's own
+    model. `min_date` and `max_date` default to the earliest and latest dates
+    in the queryset.
+
+    On PostgreSQL the rows are grouped by date_trunc() in the database. Other
+    backends fetch just the date (and sum) column and total them in Python.
+    """
+    import datetime
+    from django.db import connections
+    from django.db.models import Count, Max, Min, Sum
+    from django.db.models.query import EmptyQuerySet
+
+    if isinstance(queryset, EmptyQuerySet): # Its aggregate() and filter() still query the whole table
+        return []
+    def to_date(d):
+        return d.date() if isinstance(d, datetime.datetime) else d
+
+    if min_date is None or max_date is None:
+        bounds = queryset.aggregate(min=Min(date_field), max=Max(date_field))
+        if bounds['min'] is None:
+            return []
+        min_date = to_date(min_date or bounds['min'])
+        max_date = to_date(max_date or bounds['max'])
+
+    ranges = list(date_breakdown(min_date, max_date, freq))
+    # Weeks are anchored at max_date rather than at a calendar week, so they're folded from daily totals.
+    unit = freq == 'm' and 'month' or 'day'
+    def bucket_of(d):
+        d = to_date(d)
+        return unit == 'month' and datetime.date(d.year, d.month, 1) or d
+
+    # The oldest range can start before min_date, and every row in it counts, as with date_breakdown.
+    queryset = queryset.filter(**{
+        date_field + '__gte': ranges[-1][0],
+        date_field + '__lt': max_date + datetime.timedelta(days=1),
+    }).order_by()
+
+    totals = {}
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        qn = connection.ops.quote_name
+        column = '%s.%s' % (qn(queryset.model._meta.db_table), qn(queryset.model._meta.get_field(date_field).column))
+        rows = queryset.extra(select={'bucket': "date_trunc('%s', %s)" % (unit, column)}).values('bucket')
+        rows = rows.annotate(value=sum_field and Sum(sum_field) or Count('pk'))
+        for row in rows:
+            totals[bucket_of(row['bucket'])] = row['value'] or 0
+    elif sum_field:
+        for d, value in queryset.values_list(date_field, sum_field).iterator():
+            if value is not None:
+                key = bucket_of(d)
+                totals[key] = totals.get(key, 0) + value
+    else:
+        for d in queryset.values_list(date_field, flat=True).iterator():
+            key = bucket_of(d)
+            totals[key] = totals.get(key, 0) + 1
+
+    result = []
+    for start, end in ranges:
+        if freq == 'w':
+            value = sum(totals.get(start + datetime.timedelta(days=i), 0) for i in range(7))
+        else:
+            value = totals.get(bucket_of(start), 0)
+        result.append((start, end, value))
+    return result
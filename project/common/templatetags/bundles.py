@@ -0,0 +1,41 @@
+import os
+
+from django import template
+from django.conf import settings
+from django.utils import simplejson
+
+register = template.Library()
+
+TAGS = {
+    '.css': '<link rel="stylesheet" href="%s">',
+    '.js': '<script src="%s"></script>',
+}
+
+_manifest = None
+
+def get_manifest():
+    """
+    Returns the processor's {bundle name: hashed path} map, or {} if it hasn't
+    run, as in development. A release never changes it, so it's read once.
+    """
+    global _manifest
+    if _manifest is None:
+        try:
+            _manifest = simplejson.load(open(settings.BUNDLE_MANIFEST))
+        except IOError:
+            _manifest = {}
+    return _manifest
+
+@register.simple_tag
+def bundle(name):
+    """
+    {% bundle "js/site.js" %} links the built bundle, or without a manifest,
+    each of the files bundles.json lists for it.
+    """
+    tag = TAGS[os.path.splitext(name)[1]]
+    path = get_manifest().get(name)
+    if path:
+        return tag % (settings.STATIC_URL + path)
+    # Read on every use, so edits show up in development
+    sources = simplejson.load(open(settings.BUNDLES))[name]
+    return '\n'.join(tag % (settings.STATIC_URL + source) for source in sources)
@@ -1,7 +1,19 @@
-from django.test import Client
+import datetime, decimal, os, shutil, tempfile, uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, TestCase
+from django.utils import simplejson
 from django.core.handlers.base import BaseHandler
 from django.core.handlers.wsgi import WSGIRequest
 
+from common.benchmarks import make_model, scratch_table
+from common.fields import UUIDField, ordered_uuids
+from common.models import BaseModel
+from common.shortcuts import time_buckets
+from common.views import json_encoder, json_response
+
 class RequestFactory(Client):
     """
     copied from http://www.djangosnippets.org/snippets/963/
@@ -20,11 +32,22 @@ class RequestFactory(Client):
     just as if that view had been hooked up using a URLconf.
     
     """
-    def request(self, **request):
-        """
-        Similar to parent class, but returns the request object as soon as it
-        has created it.
-        """
+    # Loading middleware imports and instantiates every class in
+    # MIDDLEWARE_CLASSES, so it's done once and shared by all instances.
+    _handler = None
+    _handler_middleware = None
+
+    @classmethod
+    def get_handler(cls):
+        """Returns a BaseHandler with middleware loaded, reloading only if MIDDLEWARE_CLASSES changed."""
+        if cls._handler is None or cls._handler_middleware != settings.MIDDLEWARE_CLASSES:
+            handler = BaseHandler()
+            handler.load_middleware()
+            cls._handler, cls._handler_middleware = handler, settings.MIDDLEWARE_CLASSES
+        return cls._handler
+
+    def get_environ(self, **request):
+        """Returns the WSGI environ for a request, as request() would build it."""
         environ = {
             'HTTP_COOKIE': self.cookies,
             'PATH_INFO': '/',
@@ -37,11 +60,158 @@ class RequestFactory(Client):
         }
         environ.update(self.defaults)
         environ.update(request)
-        request = WSGIRequest(environ)
-        handler = BaseHandler()
-        handler.load_middleware()
-        for middleware_method in handler._request_middleware:
+        return environ
+
+    def request(self, **request):
+        """
+        Similar to parent class, but returns the request object as soon as it
+        has created it.
+        """
+        request = WSGIRequest(self.get_environ(**request))
+        for middleware_method in self.get_handler()._request_middleware:
             if middleware_method(request):
                 raise Exception("Couldn't create request mock object - "
                                 "request middleware returned a response")
         return request
+
+class SchemaHashTest(TestCase):
+    def make_app(self, models_source='class Foo: pass\n'):
+        """Makes a throwaway app with models, a migration and a fixture; returns its models.py."""
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app_dir = os.path.join(root, 'releases', os.path.basename(root), 'app')
+        for dirname in ['migrations', 'fixtures']:
+            os.makedirs(os.path.join(app_dir, dirname))
+        for name, content in [('models.py', models_source), ('migrations/0001_initial.py', 'pass\n'),
+                ('fixtures/initial_data.json', '[]'), ('fixtures/other.json', '[1]')]:
+            open(os.path.join(app_dir, name), 'w').write(content)
+        return os.path.join(app_dir, 'models.py')
+
+    def get_hash(self, models_file):
+        from common.management.commands.prep_release import app_schema_files, hash_files
+        return hash_files(app_schema_files('app.models', models_file))
+
+    def test_same_tree_in_different_releases_hashes_the_same(self):
+        self.assertEqual(self.get_hash(self.make_app()), self.get_hash(self.make_app()))
+
+    def test_changed_models_change_the_hash(self):
+        self.assertNotEqual(self.get_hash(self.make_app()), self.get_hash(self.make_app('class Bar: pass\n')))
+
+    def test_only_initial_data_fixtures_count(self):
+        from common.management.commands.prep_release import app_schema_files
+        names = [name for name, filename in app_schema_files('app.models', self.make_app())]
+        self.assertEqual(names, ['app.models/models.py', 'app.models/migrations/0001_initial.py',
+            'app.models/fixtures/initial_data.json'])
+
+class UUIDFieldTest(TestCase):
+    def test_round_trip(self):
+        field = UUIDField()
+        value = uuid.uuid4().hex
+        self.assertEqual(field.to_python(field.get_db_prep_value(value, connection=connection)), value)
+        self.assertEqual(field.to_python(str(uuid.UUID(value))), value)
+        self.assertEqual(field.to_python(uuid.UUID(value)), value)
+        self.assertEqual(field.get_db_prep_value(None, connection=connection), None)
+
+    def test_save_and_look_up(self):
+        with scratch_table(make_model('UUIDFieldTestModel', BaseModel)) as model:
+            obj = model.objects.create(notes='hello')
+            self.assertEqual(len(obj.id), 32)
+            self.assertEqual(model.objects.get(pk=obj.id).notes, 'hello')
+            self.assertEqual(model.objects.get(pk=obj.id).id, obj.id)
+            self.assertEqual(list(model.objects.filter(id__in=[obj.id]).values_list('notes', flat=True)), ['hello'])
+
+class OrderedUUIDTest(TestCase):
+    def test_ordered_uuids_increase(self):
+        # More than the 4096 a millisecond's sequence number allows
+        ids = ordered_uuids(5000) + ordered_uuids(10)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(set(uuid.UUID(hex).version for hex in ids), set([7]))
+
+    def test_ordered(self):
+        model = type('Model', (object,), {'ordered_ids': False})()
+        self.assertEqual(uuid.UUID(UUIDField(ordered=True).new_values(model, 1)[0]).version, 7)
+        self.assertEqual(uuid.UUID(UUIDField().new_values(model, 1)[0]).version, 4)
+        model.ordered_ids = True
+        self.assertEqual(uuid.UUID(UUIDField().new_values(model, 1)[0]).version, 7)
+
+    def test_bulk_ids_are_ordered(self):
+        model = make_model('OrderedUUIDTestModel', BaseModel, ordered_ids=True)
+        objs = [model() for i in range(10)]
+        model._meta.pk.assign_values(objs)
+        ids = [obj.id for obj in objs]
+        self.assertEqual(ids, sorted(ids))
+
+class TimeBucketsTest(TestCase):
+    def setUp(self):
+        for i, joined in enumerate([datetime.datetime(2012, 1, 31, 23, 59), datetime.datetime(2012, 2, 1),
+                datetime.datetime(2012, 2, 7, 12), datetime.datetime(2012, 2, 8, 23, 59)]):
+            User.objects.create(username='user%d' % i, date_joined=joined)
+
+    def buckets(self, freq, min_date=None, max_date=None):
+        return time_buckets(User.objects.all(), 'date_joined', freq, min_date, max_date)
+
+    def test_days(self):
+        self.assertEqual(self.buckets('d', datetime.date(2012, 2, 6)), [
+            (datetime.date(2012, 2, 8), datetime.date(2012, 2, 8), 1),
+            (datetime.date(2012, 2, 7), datetime.date(2012, 2, 7), 1),
+            (datetime.date(2012, 2, 6), datetime.date(2012, 2, 6), 0)])
+
+    def test_weeks_end_on_max_date(self):
+        self.assertEqual(self.buckets('w'), [
+            (datetime.date(2012, 2, 2), datetime.date(2012, 2, 8), 2),
+            (datetime.date(2012, 1, 26), datetime.date(2012, 2, 1), 2)])
+
+    def test_months(self):
+        self.assertEqual(self.buckets('m'), [
+            (datetime.date(2012, 2, 1), datetime.date(2012, 2, 8), 3),
+            (datetime.date(2012, 1, 1), datetime.date(2012, 1, 31), 1)])
+
+    def test_rows_after_max_date_are_left_out(self):
+        self.assertEqual(self.buckets('m', max_date=datetime.date(2012, 2, 7)), [
+            (datetime.date(2012, 2, 1), datetime.date(2012, 2, 7), 2),
+            (datetime.date(2012, 1, 1), datetime.date(2012, 1, 31), 1)])
+
+    def test_empty(self):
+        self.assertEqual(time_buckets(User.objects.none(), 'date_joined', 'd'), [])
+
+class JSONTest(TestCase):
+    def test_encoder(self):
+        value = uuid.uuid4()
+        self.assertEqual(simplejson.loads(json_encoder.encode({
+            'date': datetime.date(2012, 2, 1),
+            'datetime': datetime.datetime(2012, 2, 1, 12, 30),
+            'decimal': decimal.Decimal('1.10'),
+            'uuid': value,
+            'binary': buffer(value.bytes),
+        })), {
+            'date': '2012-02-01',
+            'datetime': '2012-02-01T12:30:00',
+            'decimal': '1.10',
+            'uuid': value.hex,
+            'binary': value.hex,
+        })
+
+    def test_streamed_in_chunks(self):
+        items = [{'id': i, 'at': datetime.date(2012, 2, 1)} for i in range(2000)]
+        for obj in [items, iter(items)]:
+            chunks = list(json_response(obj))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(simplejson.loads(''.join(chunks)), [{'id': i, 'at': '2012-02-01'} for i in range(2000)])
+
+    def test_querysets_are_read_before_returning(self):
+        User.objects.create(username='someone')
+        response = json_response(User.objects.values('username'))
+        User.objects.all().delete()
+        self.assertEqual(simplejson.loads(response.content), [{'username': 'someone'}])
+
+    def test_empty_and_single_values(self):
+        self.assertEqual(json_response(iter([])).content, '[]')
+        self.assertEqual(json_response({'a': 1}).content, '{"a": 1}')
+
+    def test_unencodable_items_fail_in_the_view(self):
+        def items():
+            yield 1
+            yield object()
+        self.assertRaises(TypeError, json_response, [1, object()])
+        self.assertRaises(TypeError, json_response, items())
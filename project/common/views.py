@@ -1,16 +1,93 @@
 """Helpers relating to views."""
 
-from django.http import HttpResponse
+import binascii, datetime, decimal, hashlib, itertools, time, uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, HttpResponseForbidden
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from django.utils import simplejson
+
+JSON_CHUNK_SIZE = 16 * 1024
+
+class JSONEncoder(simplejson.JSONEncoder):
+    """
+    Also encodes dates and times (ISO 8601), Decimals (as strings, so no
+    precision is lost) and UUIDs, including raw binary UUIDField values, as hex.
+    """
+    def default(self, obj):
+        if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+            return obj.isoformat()
+        if isinstance(obj, decimal.Decimal):
+            return str(obj)
+        if isinstance(obj, uuid.UUID):
+            return obj.hex
+        if isinstance(obj, buffer) and len(obj) == 16:
+            return binascii.hexlify(obj)
+        return super(JSONEncoder, self).default(obj)
+
+json_encoder = JSONEncoder()
+
+def _iterencode_items(items):
+    yield '['
+    for i, item in enumerate(items):
+        if i:
+            yield ', '
+        for piece in json_encoder.iterencode(item):
+            yield piece
+    yield ']'
+
+def _chunked(pieces):
+    """Joins the many small strings from `pieces` into chunks of about JSON_CHUNK_SIZE."""
+    chunk, size = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if size >= JSON_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+def _eager_first(chunks):
+    """Encodes the first of `chunks` now, so an error there is raised in the view (a 500)."""
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return []
+    return itertools.chain([first], chunks)
 
 def json_response(obj):
-    """Makes JSON HttpResponse out of obj."""
-    from django.http import HttpResponse
-    from django.utils import simplejson
-    return HttpResponse(simplejson.dumps(obj), mimetype='application/javascript')
+    """
+    Makes JSON HttpResponse out of obj.
+
+    Lists, querysets and other iterables are encoded as a JSON array in chunks,
+    so they are never joined into one big string. That is done before
+    returning, while the database connection and the request's transaction
+    are still open, so an unencodable item is a 500 rather than a truncated
+    200.
+
+    Generators and other iterators are encoded as the response is sent, to
+    keep memory flat. By then the request is over and its database connection
+    closed, so they mustn't touch the ORM; read what they need first. Their
+    first chunk is encoded before returning.
+    """
+    if isinstance(obj, QuerySet):
+        obj = obj.iterator() # Don't fill the queryset's result cache
+        content = list(_chunked(_iterencode_items(obj)))
+    elif isinstance(obj, (dict, basestring)) or not hasattr(obj, '__iter__'):
+        content = json_encoder.encode(obj)
+    elif iter(obj) is obj:
+        content = _eager_first(_chunked(_iterencode_items(obj)))
+    else:
+        content = list(_chunked(_iterencode_items(obj)))
+    return HttpResponse(content, mimetype='application/javascript')
 
 def json(f):
     """Decorator for views that return JSON."""
-    from functools import wraps
     @wraps(f)
     def json_view(*args, **kwargs):
         result = f(*args, **kwargs)
@@ -19,16 +96,109 @@ def json(f):
         return json_response(result)
     return json_view
 
+VIEW_CACHE_NAMESPACE_TIMEOUT = 60 * 60 * 24 * 30 # memcached's longest relative timeout
+
+def _view_cache_key(*parts):
+    return '%sview:%s' % (settings.CACHE_MIDDLEWARE_KEY_PREFIX, ':'.join(str(p) for p in parts))
+
+def _request_value(request, attr):
+    """Looks up e.g. 'path', 'GET', 'user.id' or 'META.HTTP_ACCEPT_LANGUAGE' on request."""
+    value = request
+    for name in attr.split('.'):
+        if hasattr(value, name):
+            value = getattr(value, name)
+        else:
+            value = value.get(name)
+    if hasattr(value, 'lists'): # QueryDict
+        return sorted(value.lists())
+    if isinstance(value, dict):
+        return sorted(value.items())
+    return value
+
+def _namespace_version(namespace):
+    key = _view_cache_key('namespace', namespace)
+    version = cache.get(key)
+    if version is None:
+        # Start from the time, so versions don't repeat if memcached loses the key
+        cache.add(key, int(time.time()), VIEW_CACHE_NAMESPACE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def invalidate_view_cache(namespace):
+    """Drops every response cached_view has cached in `namespace`."""
+    try:
+        cache.incr(_view_cache_key('namespace', namespace))
+    except ValueError:
+        pass # No version yet, so nothing is cached under the namespace
+
+def cached_view(timeout=60, vary_on=('path', 'GET'), namespace=None, grace=None, lock_timeout=10):
+    """
+    Decorator that caches a view's 200 responses to GET and HEAD requests in
+    the default cache. Goes outside @json, and works for views that use
+    req_render_to_response too.
+
+    The key varies on the request attributes in `vary_on`, like 'path', 'GET',
+    'user.id' or 'META.HTTP_ACCEPT_LANGUAGE'. It also includes a version
+    number for `namespace` (default: the view's dotted name), so that
+    invalidate_view_cache(namespace) drops all of its responses at once.
+    Don't cache pages with per-user content, like CSRF tokens or messages,
+    unless vary_on includes the user.
+
+    To avoid stampedes, entries are kept for `grace` seconds (default:
+    `timeout`) after they go stale. The first request to see a stale entry
+    takes a lock and recomputes it while the rest keep getting the stale
+    copy. When there is no copy at all, the rest wait up to `lock_timeout`
+    seconds for the one computing it, or compute it themselves if the cache
+    is unavailable.
+    """
+    if grace is None:
+        grace = timeout
+    def decorator(view):
+        view_namespace = namespace or '%s.%s' % (view.__module__, view.__name__)
+        @wraps(view)
+        def cached(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            vary = [_request_value(request, attr) for attr in vary_on] + [args, sorted(kwargs.items())]
+            key = _view_cache_key(view_namespace, _namespace_version(view_namespace),
+                hashlib.md5(repr(vary)).hexdigest())
+            lock_key = key + ':lock'
+
+            entry = cache.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+            locked = cache.add(lock_key, 1, lock_timeout)
+            if entry is not None and not locked:
+                return entry[0] # Stale, but someone else is already recomputing it
+            if not locked:
+                # Someone else is computing it; give them a chance to finish. If the
+                # lock can't be read either, the cache is down, and there's no point.
+                give_up_at = time.time() + lock_timeout
+                while time.time() < give_up_at and cache.get(lock_key) is not None:
+                    time.sleep(0.05)
+                    entry = cache.get(key)
+                    if entry is not None:
+                        return entry[0]
+
+            try:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    response.content = response.content # Streamed content can't be pickled
+                    cache.set(key, (response, time.time() + timeout), timeout + grace)
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+            return response
+        return cached
+    return decorator
+
 def req_render_to_response(request, template, context=None):
     """render_to_response with request context"""
-    from django.shortcuts import render_to_response
-    from django.template import RequestContext
     context = context or {}
     rc = RequestContext(request, context)
     return render_to_response(template, context_instance=rc)
 
 def response_403(content='Permission denied'):
-    from django.http import HttpResponseForbidden
     return HttpResponseForbidden(content)
 
 def get_post_action(post):
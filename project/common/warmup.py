@@ -0,0 +1,42 @@
+"""Work done at process start, so the first requests after a deploy or restart don't pay for it."""
+
+import os
+
+from django.conf import settings
+from django.contrib import admin
+from django.core.urlresolvers import get_resolver
+from django.db.models.loading import get_models
+from django.template.loader import get_template
+from django.template.loaders.app_directories import app_template_dirs
+
+from common import log
+
+def template_names():
+    """Yields the name of every file under TEMPLATE_DIRS and the installed apps' template dirs."""
+    for template_dir in list(settings.TEMPLATE_DIRS) + list(app_template_dirs):
+        for dirpath, dirnames, filenames in os.walk(template_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    yield os.path.relpath(os.path.join(dirpath, filename), template_dir)
+
+def warm_templates():
+    """
+    Compiles every template into the cached loader. Does nothing unless
+    CACHED_TEMPLATES is on, since otherwise the compiled templates are thrown away.
+    """
+    if not getattr(settings, 'CACHED_TEMPLATES', False):
+        return
+    for name in template_names():
+        try:
+            get_template(name)
+        except Exception, e:
+            # Not every file in a template dir is a template that compiles on its own
+            log.warning('Not warming template', name, e)
+
+def warm_up():
+    """Imports every app's models, admin modules and the URLconf, then warms templates."""
+    get_models()
+    admin.autodiscover() # urls.py calls this too; it's only done once
+    get_resolver(None).url_patterns # Imports the URLconf
+    warm_templates()
@@ -1,4 +1,10 @@
 #!/usr/bin/env python
+import os, site, sys
+# On the servers, each release links env/ to the virtualenv built for its
+# requirements.txt, so run from current/ this uses current/env, like wsgi.py
+site.addsitedir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'env',
+    'lib', 'python%d.%d' % sys.version_info[:2], 'site-packages'))
+
 from django.core.management import execute_manager
 import imp
 try:
@@ -42,6 +42,15 @@ STATIC_ROOT = root_dir('..', 'static')
 
 STATIC_URL = '/static/'
 
+# Hashes of the collected static files, so the next release can hardlink
+# the unchanged ones (see collectstatic_incremental)
+STATIC_MANIFEST = root_dir('..', 'static_manifest.json')
+
+# JS/CSS bundles, and the hashed files server/processor builds from them on
+# deploy (see the {% bundle %} tag)
+BUNDLES = root_dir('bundles.json')
+BUNDLE_MANIFEST = root_dir('bundles_manifest.json')
+
 # Collect static files from within app code directory
 STATICFILES_DIRS = (
     root_dir('static'),
@@ -67,6 +76,11 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.Loader',
 )
 
+# Keep compiled templates in memory (see the end of this file). Template
+# changes then only show up after a restart, so the stagesettings.py the
+# fabfile renders turns it on only for stages with cached_templates set.
+CACHED_TEMPLATES = False
+
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -93,6 +107,7 @@ INSTALLED_APPS = (
     # 'django.contrib.admindocs',
     'south',
     'registration',
+    'common',
     'main'
 )
 
@@ -150,6 +165,11 @@ CACHES = {
 # Prevent project cache collisions
 CACHE_MIDDLEWARE_KEY_PREFIX = PROJECT_NAME + ':'
 
+# For common.log; stagesettings points LOG_DIRECTORY at the project's log dir on servers
+LOG_DIRECTORY = root_dir('..', 'log')
+LOG_QUEUE = True # Write records from a background thread instead of the logging one
+LOG_LEVEL = 1
+
 try:
     from stagesettings import *
 except ImportError:
@@ -160,4 +180,7 @@ try:
 except ImportError:
     pass
 
-
+if CACHED_TEMPLATES:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
@@ -0,0 +1,22 @@
+CACHED_TEMPLATES = {{ cached_templates }}
+
+# Rotated by server/logrotate/django
+LOG_DIRECTORY = '/project/{{ PROJECT_NAME }}/log'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': '{{ PROJECT_NAME }}',
+        'USER': '{{ PROJECT_NAME }}',
+        'PASSWORD': '{{ DB_PASS }}',
+        'HOST': '{{ database_host }}',
+        'PORT': '{{ database_port }}', # pgbouncer's, unless POOLER_PORT is None
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': '{{ cache_backend }}',
+        'LOCATION': [{% for location in cache_locations %}'{{ location }}', {% endfor %}],
+    }
+}
@@ -2,9 +2,16 @@ import os, sys, site
 sys.path.insert(0, '/project/{{ PROJECT_NAME }}/current')
 # The project root should be on the pythonpath. This lets you drop-in 3rd-party apps.
 sys.path.insert(0, '/project/{{ PROJECT_NAME }}/current/{{ PROJECT_NAME }}')
-site.addsitedir('/envs/{{ PROJECT_NAME }}/lib/python{{ PYTHON_VERSION_STR }}/site-packages/')
+# Each release links to the virtualenv built for its requirements.txt
+site.addsitedir('/project/{{ PROJECT_NAME }}/current/env/lib/python{{ PYTHON_VERSION_STR }}/site-packages/')
 
 os.environ['DJANGO_SETTINGS_MODULE'] = '{{ PROJECT_NAME }}.settings'
 
 import django.core.handlers.wsgi
 application = django.core.handlers.wsgi.WSGIHandler()
+
+# mod_wsgi imports this when each daemon process starts (see WSGIImportScript
+# in the vhost), so do the work that would otherwise fall on its first requests
+from common.warmup import warm_up
+warm_up()
+application.load_middleware()
@@ -0,0 +1,128 @@
+"""
+Tests for the parts of fabfile.py that run locally. From this directory:
+
+    python -m unittest test_fabfile
+
+Uses fab_settings.py if there is one, and stand-in settings if not.
+"""
+import subprocess, sys, types, unittest
+
+try:
+    import fab_settings
+except ImportError:
+    fab_settings = types.ModuleType('fab_settings')
+    fab_settings.__dict__.update({
+        'PROJECT_NAME': 'project',
+        'DOMAIN': 'project.com',
+        'DJANGO_PORT': 81,
+        'PROJECT_DIR': '/project/project',
+        'VIRTUALENV': '/envs/project',
+    })
+    sys.modules['fab_settings'] = fab_settings
+
+from fabric.api import abort
+
+import fabfile
+from fabfile import Batch, Pip, Releases, Timeline, _capture_host_failure
+
+class BatchTest(unittest.TestCase):
+    def run_script(self, commands):
+        process = subprocess.Popen(['bash', '-c', Batch().get_script(commands)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return process.communicate()[0], process.returncode
+
+    def test_stops_at_the_first_failure(self):
+        output, status = self.run_script(['echo one', 'sh -c "exit 3"', 'echo three'])
+        self.assertEqual(status, 3)
+        self.assertEqual(Batch.parse_failure(output), (1, 3))
+        self.assertTrue('three' not in output)
+
+    def test_and_or_inside_a_command(self):
+        output, status = self.run_script(['false && echo no || true', 'test -d /'])
+        self.assertEqual(status, 0)
+        self.assertEqual(Batch.parse_failure(output), (None, None))
+
+    def test_ignores_other_output(self):
+        output = 'Welcome to Ubuntu\necho %s 1 2\n%s 5 127\n' % ((Batch.FAILURE_MARKER,) * 2)
+        self.assertEqual(Batch.parse_failure(output), (5, 127))
+
+    def test_times_each_command(self):
+        output, status = self.run_script(['sleep 0.2', 'true'])
+        times = Batch.parse_times(output)
+        self.assertEqual(sorted(times), [0, 1, 2])
+        self.assertTrue(0.2 <= times[1] - times[0] < 1)
+
+class CaptureHostFailureTest(unittest.TestCase):
+    def test_keeps_the_abort_message(self):
+        def fails():
+            abort("No release dir")
+        succeeded, error, events = _capture_host_failure(fails)()
+        self.assertEqual((succeeded, error), (False, "No release dir"))
+
+    def test_returns_the_result(self):
+        self.assertEqual(_capture_host_failure(lambda: 'ok')()[:2], (True, 'ok'))
+
+class PruneTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = Releases.read_index, Releases.write_index, Releases.prune_virtualenvs, fabfile.Batch, fabfile.run
+        self.moved = []
+        self.releases = [{'name': '2012-01-0%d-00-00-00_abc' % i, 'activated_at': None} for i in range(1, 6)]
+        self.releases[2]['activated_at'] = '2012-01-03'
+        self.releases[3]['activated_at'] = '2012-01-04'
+        Releases.read_index = staticmethod(lambda: ([dict(r) for r in self.releases], self.releases[3]['name']))
+        Releases.write_index = staticmethod(lambda releases: None)
+        Releases.prune_virtualenvs = staticmethod(lambda kept: None)
+        test = self
+        class RecordingBatch(Batch):
+            def add(self, cmd):
+                test.moved.extend(cmd.split()[3:4]) # [ ! -e <release_dir> ] || mv ...
+            def execute(self):
+                pass
+        fabfile.Batch = RecordingBatch
+        fabfile.run = lambda command, **kwargs: None
+
+    def tearDown(self):
+        (Releases.read_index, Releases.write_index, Releases.prune_virtualenvs,
+            fabfile.Batch, fabfile.run) = [staticmethod(f) for f in self.saved[:3]] + list(self.saved[3:])
+
+    def pruned(self, keep):
+        Releases.prune(keep)
+        return sorted(name.split('/')[-1] for name in self.moved)
+
+    def test_keep_zero_keeps_only_current_and_previous(self):
+        self.assertEqual(self.pruned('0'), [self.releases[i]['name'] for i in (0, 1, 4)])
+
+    def test_keep_newest(self):
+        self.assertEqual(self.pruned(2), [self.releases[i]['name'] for i in (0, 1)])
+
+class PruneVirtualenvsTest(unittest.TestCase):
+    def setUp(self):
+        self.run, self.sudo = fabfile.run, fabfile.sudo
+        self.sudo_commands = []
+        fabfile.sudo = lambda command, **kwargs: self.sudo_commands.append(command)
+
+    def tearDown(self):
+        fabfile.run, fabfile.sudo = self.run, self.sudo
+
+    def test_deletes_only_unlinked_virtualenvs(self):
+        ve = fabfile.VIRTUALENV
+        fabfile.run = lambda command, **kwargs: '\n'.join([ve + '-aaaaaaaaaaaa', ve + '-bbbbbbbbbbbb',
+            Pip.get_virtualenv_dir(), ve + '-other-project', Releases.CURRENT_MARKER, ve + '-aaaaaaaaaaaa'])
+        Releases.prune_virtualenvs(['2012-01-01-00-00-00_abc'])
+        self.assertEqual(self.sudo_commands, ['nohup rm -rf %s-bbbbbbbbbbbb > /dev/null 2>&1 &' % ve])
+
+class TimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.events, Timeline.events = Timeline.events, []
+
+    def tearDown(self):
+        Timeline.events = self.events
+
+    def test_reported_steps(self):
+        Timeline.add_reported_steps('Migrating...\nTIMELINE_STEP 100.5 103.0 prep_release: migrate\n'
+            'TIMELINE_STEP bad\n')
+        self.assertEqual([(e['kind'], e['command'], e['start'], e['duration']) for e in Timeline.events],
+            [('step', 'prep_release: migrate', 100.5, 2.5)])
+
+if __name__ == '__main__':
+    unittest.main()